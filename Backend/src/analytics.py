@@ -0,0 +1,245 @@
+"""
+Course analytics
+
+Per-course counters (groups, members, open groups, events, requests and their
+outcomes) and weekly event counts live in summary tables. The write routes
+bump them in the same transaction as the write, so reading them costs
+O(courses) however much activity there is. `flask rebuild-analytics`
+recomputes both tables from the live and archived data with set-based SQL.
+
+A course has a course_stats row once its summaries are complete. Courses
+without one (e.g. created before these tables existed) are backfilled by
+`flask init-db` and `flask migrate-tenants`, or the first time they are
+bumped. Until then reads compute their summaries from the data, without
+writing them.
+"""
+
+import datetime
+
+from sqlalchemy import Date, case, cast, func, select, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+
+from db import db
+from db import ArchivedEvent
+from db import ArchivedRequest
+from db import Course
+from db import CourseStats
+from db import CourseWeeklyEvents
+from db import Event
+from db import Group
+from db import Request
+from db import user_group_association_table
+
+
+DEFAULT_WEEKS = 8
+
+COUNTERS = ("group_count", "member_count", "open_group_count", "event_count",
+            "request_count", "accepted_count", "denied_count")
+
+
+def week_start(time):
+    """
+    Returns the Monday of the week a datetime falls in
+    """
+    return time.date() - datetime.timedelta(days=time.weekday())
+
+
+def _lock_course(course_id):
+    #Serializes the first writes to a course on PostgreSQL; SQLite serializes writers anyway
+    db.session.execute(select(Course.id).where(Course.id == course_id).with_for_update())
+
+
+def _upsert_add(table, keys, deltas):
+    """
+    Adds deltas to a summary row, creating it if it does not exist
+    """
+    dialect = postgresql if db.session.get_bind().dialect.name == "postgresql" else sqlite
+    insert = dialect.insert(table).values(**keys, **deltas)
+    db.session.execute(insert.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={col: table.c[col] + insert.excluded[col] for col in deltas}))
+
+
+def bump(course_id, **deltas):
+    """
+    Adds to a course's counters, e.g. bump(course_id, group_count=1). Call it
+    after making the change it counts.
+
+    Returns true if the course had no summary rows yet and was rebuilt
+    instead, which already counts the change
+    """
+    stats = CourseStats.__table__
+    _lock_course(course_id)
+    if db.session.execute(select(stats.c.course_id).where(stats.c.course_id == course_id)).first() is None:
+        db.session.flush()
+        rebuild([course_id])
+        return True
+    if deltas:
+        db.session.execute(stats.update().where(stats.c.course_id == course_id).values(
+            {stats.c[col]: stats.c[col] + delta for col, delta in deltas.items()}))
+    return False
+
+
+def bump_event(course_id, time, delta):
+    """
+    Counts an event created (delta=1) or deleted (delta=-1)
+    """
+    if not bump(course_id, event_count=delta):
+        _upsert_add(CourseWeeklyEvents.__table__,
+                    {"course_id": course_id, "week_start": week_start(time)}, {"event_count": delta})
+
+
+def backfill():
+    """
+    Rebuilds the summary rows of courses that have none. Does not commit.
+
+    Returns the number of rebuilt courses
+    """
+    without_stats = select(Course.id).where(Course.id.notin_(select(CourseStats.course_id)))
+    missing = [row[0] for row in db.session.execute(without_stats)]
+    if not missing:
+        return 0
+    for course_id in missing:
+        _lock_course(course_id)
+    #A concurrent bump may have rebuilt some of them before the locks were taken
+    missing = [row[0] for row in db.session.execute(without_stats.where(Course.id.in_(missing)))]
+    if missing:
+        rebuild(missing)
+    return len(missing)
+
+
+def _week_start_sql(column):
+    if db.session.get_bind().dialect.name == "postgresql":
+        return cast(func.date_trunc("week", column), Date)
+    return func.date(column, "weekday 0", "-6 days")
+
+
+def _course_stats_select(course_ids=None):
+    """
+    SELECT producing a course_stats row for every course (or the given ones)
+    """
+    group = Group.__table__
+    members = user_group_association_table
+    events = union_all(
+        select(Event.group_id.label("group_id")),
+        select(ArchivedEvent.group_id.label("group_id"))).subquery()
+    requests = union_all(
+        select(Request.group_id.label("group_id"), Request.status.label("status")),
+        select(ArchivedRequest.group_id.label("group_id"), ArchivedRequest.status.label("status"))).subquery()
+
+    groups_by_course = select(
+        group.c.course_id,
+        func.count().label("groups"),
+        func.sum(case((group.c.accepting_members, 1), else_=0)).label("open_groups")
+    ).group_by(group.c.course_id).subquery()
+    members_by_course = select(group.c.course_id, func.count().label("members")).select_from(
+        members.join(group, members.c.group_id == group.c.id)).group_by(group.c.course_id).subquery()
+    events_by_course = select(group.c.course_id, func.count().label("events")).select_from(
+        events.join(group, events.c.group_id == group.c.id)).group_by(group.c.course_id).subquery()
+    requests_by_course = select(
+        group.c.course_id,
+        func.count().label("requests"),
+        func.sum(case((requests.c.status == True, 1), else_=0)).label("accepted"),
+        func.sum(case((requests.c.status == False, 1), else_=0)).label("denied")
+    ).select_from(requests.join(group, requests.c.group_id == group.c.id)).group_by(group.c.course_id).subquery()
+
+    query = select(
+        Course.id,
+        func.coalesce(groups_by_course.c.groups, 0),
+        func.coalesce(members_by_course.c.members, 0),
+        func.coalesce(groups_by_course.c.open_groups, 0),
+        func.coalesce(events_by_course.c.events, 0),
+        func.coalesce(requests_by_course.c.requests, 0),
+        func.coalesce(requests_by_course.c.accepted, 0),
+        func.coalesce(requests_by_course.c.denied, 0)
+    ).select_from(
+        Course.__table__
+        .outerjoin(groups_by_course, groups_by_course.c.course_id == Course.id)
+        .outerjoin(members_by_course, members_by_course.c.course_id == Course.id)
+        .outerjoin(events_by_course, events_by_course.c.course_id == Course.id)
+        .outerjoin(requests_by_course, requests_by_course.c.course_id == Course.id))
+    if course_ids is not None:
+        query = query.where(Course.id.in_(course_ids))
+    return query
+
+
+def _weekly_select(course_ids=None):
+    group = Group.__table__
+    events = union_all(
+        select(Event.group_id.label("group_id"), Event.time.label("time")),
+        select(ArchivedEvent.group_id.label("group_id"), ArchivedEvent.time.label("time"))).subquery()
+    week = _week_start_sql(events.c.time)
+    query = select(group.c.course_id, week, func.count()).select_from(
+        events.join(group, events.c.group_id == group.c.id)).group_by(group.c.course_id, week)
+    if course_ids is not None:
+        query = query.where(group.c.course_id.in_(course_ids))
+    return query
+
+
+def rebuild(course_ids=None):
+    """
+    Recomputes the summary rows of every course (or of the given ones) from
+    scratch. Does not commit.
+    """
+    stats = CourseStats.__table__
+    weekly = CourseWeeklyEvents.__table__
+    delete_stats, delete_weekly = stats.delete(), weekly.delete()
+    if course_ids is not None:
+        delete_stats = delete_stats.where(stats.c.course_id.in_(course_ids))
+        delete_weekly = delete_weekly.where(weekly.c.course_id.in_(course_ids))
+    db.session.execute(delete_stats)
+    db.session.execute(delete_weekly)
+    db.session.execute(stats.insert().from_select(("course_id",) + COUNTERS, _course_stats_select(course_ids)))
+    db.session.execute(weekly.insert().from_select(("course_id", "week_start", "event_count"),
+                                                   _weekly_select(course_ids)))
+
+
+def course_summaries(weeks=DEFAULT_WEEKS, today=None):
+    """
+    Returns the analytics of every course, with event counts for the last
+    `weeks` weeks. Read-only.
+    """
+    today = today or datetime.date.today()
+    first_week = today - datetime.timedelta(days=today.weekday(), weeks=weeks - 1)
+
+    weekly = {}
+    for row in CourseWeeklyEvents.query.filter(CourseWeeklyEvents.week_start >= first_week,
+                                               CourseWeeklyEvents.week_start <= today):
+        weekly.setdefault(row.course_id, {})[row.week_start] = row.event_count
+    week_starts = [first_week + datetime.timedelta(weeks=i) for i in range(weeks)]
+
+    columns = [getattr(CourseStats, c) for c in COUNTERS]
+    rows = db.session.query(Course.id, Course.course_code, Course.course_title, CourseStats.course_id,
+                            *columns).outerjoin(CourseStats, CourseStats.course_id == Course.id).order_by(Course.id)
+    rows = rows.all()
+
+    #Courses that have not been backfilled yet
+    missing = [row[0] for row in rows if row[3] is None]
+    computed = {}
+    if missing:
+        computed = {row[0]: row[1:] for row in db.session.execute(_course_stats_select(missing))}
+        for course_id, week, count in db.session.execute(_weekly_select(missing)):
+            if isinstance(week, str):
+                week = datetime.date.fromisoformat(week)
+            if first_week <= week <= today:
+                weekly.setdefault(course_id, {})[week] = count
+
+    summaries = []
+    for row in rows:
+        course_id, course_code, course_title = row[:3]
+        counts = dict(zip(COUNTERS, computed.get(course_id, row[4:])))
+        resolved = counts["accepted_count"] + counts["denied_count"]
+        by_week = weekly.get(course_id, {})
+        summaries.append({
+            "id": course_id,
+            "course_code": course_code,
+            "course_title": course_title,
+            "groups": counts["group_count"],
+            "members": counts["member_count"],
+            "open_groups": counts["open_group_count"],
+            "events": counts["event_count"],
+            "events_per_week": [{"week": str(w), "events": by_week.get(w, 0)} for w in week_starts],
+            "requests": counts["request_count"],
+            "acceptance_rate": counts["accepted_count"] / resolved if resolved else None
+        })
+    return summaries
@@ -1,5 +1,6 @@
 from db import db
-from flask import Flask, request
+from flask import Blueprint, Flask, current_app, g, request
+import click
 import json
 from db import User
 from db import Course
@@ -8,18 +9,54 @@ from db import Request
 from db import Event
 import os
 import user_auth
+import compression
+import changelog
+import tenancy
+import schema
+import availability
+import read_model
+import archive
+import analytics
+import rsvp
+import backup
+import deletion
 import datetime
 
-app = Flask(__name__)
 db_filename = "cms.db"
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
-
-db.init_app(app)
-with app.app_context():
-    db.create_all()
+DEFAULT_CONFIG = {
+    "SQLALCHEMY_DATABASE_URI": "sqlite:///%s" % db_filename,
+    "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+    "SQLALCHEMY_ECHO": False,
+    "SCHEMA_AUTO_SYNC": False,
+    "READ_MODEL": False,
+    "READ_MODEL_MAX_AGE": None,
+    "ADMIN_NET_IDS": [],
+    "BACKUP_DIR": "backups"
+}
+
+api = Blueprint("api", __name__, cli_group = None)
+
+
+def create_app(config = None):
+    """
+    Creates and configures an app instance.
+
+    Nothing touches the database here: engines connect on first use and the
+    schema is synced with `flask init-db`, or on the first request when
+    SCHEMA_AUTO_SYNC is set.
+    """
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    if config is not None:
+        app.config.update(config)
+
+    db.init_app(app)
+    compression.init_app(app)
+    tenancy.init_app(app, fail_response)
+    schema.init_app(app)
+    app.register_blueprint(api)
+    return app
 
 
 def success_response(data, code = 200):
@@ -38,21 +75,27 @@ def extract_token_from_header(request):
         return False, "Invalid auth header"
     return True, bearer_token
 
+def is_site_admin(user):
+    return user.net_id in current_app.config["ADMIN_NET_IDS"]
+
+def include_archived():
+    return request.args.get("include_archived", "").lower() == "true"
+
 
 #ROUTES
 #May have to edit response codes
 
-@app.route("/users/", methods = ["GET"])
+@api.route("/users/", methods = ["GET"])
 def get_all_users():
     users = [u.serialize() for u in User.query.all()]
     return success_response({"users": users}, 200)
 
-@app.route("/users/<string:net_id>/", methods = ["GET"])
+@api.route("/users/<string:net_id>/", methods = ["GET"])
 def get_user(net_id):
     user = User.query.filter_by(net_id = net_id).first()
     return success_response(user.serialize(), 200)
 
-@app.route("/register/", methods = ["POST"])
+@api.route("/register/", methods = ["POST"])
 def register_user():
     body = json.loads(request.data)
     name = body.get("name")
@@ -74,7 +117,7 @@ def register_user():
         "update_token": user.update_token
     }, 201)
 
-@app.route("/login/", methods = ["POST"])
+@api.route("/login/", methods = ["POST"])
 def login():
 
     #Checking net_id and password
@@ -96,7 +139,7 @@ def login():
         "update_token": user.update_token
     }, 200)
 
-@app.route("/session/", methods = ["POST"])
+@api.route("/session/", methods = ["POST"])
 def update_session():
     success, update_token = extract_token_from_header(request)
 
@@ -115,7 +158,7 @@ def update_session():
         }, 200
     )
 
-@app.route("/logout/", methods = ["POST"])
+@api.route("/logout/", methods = ["POST"])
 def logout():
     success, session_token = extract_token_from_header(request)
     if not success:
@@ -131,7 +174,7 @@ def logout():
         "update_token": user.update_token
         }, 200)
 
-@app.route("/courses/", methods = ["POST"])
+@api.route("/courses/", methods = ["POST"])
 def create_course():
     body = json.loads(request.data)
     course_title = body.get("course_title")
@@ -147,20 +190,57 @@ def create_course():
     
     new_course = Course(course_title = course_title, course_code = course_code)
     db.session.add(new_course)
+    db.session.flush()
+    #Creates the course's (empty) summary row
+    analytics.bump(new_course.id)
     db.session.commit()
     return success_response(new_course.serialize(), 201)
 
-@app.route("/courses/", methods = ["GET"])
+@api.route("/courses/", methods = ["GET"])
 def get_courses():
+    snapshot = read_model.current()
+    if snapshot is not None:
+        return success_response({"courses": snapshot.get_courses()}, 200)
     courses = [c.serialize() for c in Course.query.all()]
     return success_response({"courses": courses}, 200)
 
-@app.route("/courses/<int:course_id>/", methods = ["GET"])
+@api.route("/courses/<int:course_id>/", methods = ["GET"])
 def get_course(course_id):
+    snapshot = read_model.current()
+    if snapshot is not None:
+        course = snapshot.get_course(course_id)
+        if course is None:
+            return fail_response("A course with this id does not exist.")
+        return success_response(course, 200)
     course = Course.query.filter_by(id = course_id).first()
+    if course is None:
+        return fail_response("A course with this id does not exist.")
     return success_response(course.serialize(), 200)
 
-@app.route("/groups/", methods = ["POST"])
+@api.route("/courses/<int:course_id>/", methods = ["DELETE"])
+def delete_course(course_id):
+    course = Course.query.filter_by(id = course_id).first()
+    if course is None:
+        return fail_response("A course with this id does not exist.", 404)
+
+    #Verifying session 
+    success, session_token = extract_token_from_header(request)
+    if not success:
+        return fail_response(session_token, 400)
+    user = user_auth.get_user_by_session_token(session_token)
+    if user is None or not user.verify_session_token(session_token):
+        return fail_response("Invalid session token", 400)
+
+    if not is_site_admin(user):
+        return fail_response("You do not have permission to delete courses", 400)
+
+    deleted = course.serialize_simple()
+    deletion.delete_course(course.id)
+    db.session.commit()
+
+    return success_response(deleted, 200)
+
+@api.route("/groups/", methods = ["POST"])
 def create_group():
     body = json.loads(request.data)
     course_code = body.get("course_code")
@@ -186,16 +266,24 @@ def create_group():
     new_group = Group(admin_id = user.id, course_id = optional_course.id)
     new_group.users.append(user)
     db.session.add(new_group)
+    analytics.bump(optional_course.id, group_count = 1, member_count = 1, open_group_count = 1)
     db.session.commit()
 
     return success_response(new_group.serialize(), 201)
 
-@app.route("/groups/", methods = ["GET"])
+@api.route("/groups/", methods = ["GET"])
 def get_groups():
 
     body = json.loads(request.data)
     course_code = body.get("course_code")
 
+    snapshot = read_model.current()
+    if snapshot is not None:
+        groups = snapshot.get_groups(course_code)
+        if groups is None:
+            return fail_response("A course with this code does not exist.", 404)
+        return success_response({"groups": groups}, 200)
+
     #If no filtering by course code, get all groups.
     if course_code is None:
         groups = [g.serialize() for g in Group.query.all()]
@@ -213,14 +301,43 @@ def get_groups():
     
 
 
-@app.route("/groups/<int:group_id>/", methods = ["GET"])
+@api.route("/groups/<int:group_id>/", methods = ["GET"])
 def get_group(group_id):
+    snapshot = read_model.current()
+    if snapshot is not None:
+        group = snapshot.get_group(group_id)
+        if group is None:
+            return fail_response("A group with this id does not exist.")
+        return success_response(group, 200)
     group = Group.query.filter_by(id = group_id).first()
     if group is None:
         return fail_response("A group with this id does not exist.")
     return success_response(group.serialize(), 200)
 
-@app.route("/groups/<int:group_id>/requests/", methods = ["POST"])
+@api.route("/groups/<int:group_id>/", methods = ["DELETE"])
+def delete_group(group_id):
+    group = Group.query.filter_by(id = group_id).first()
+    if group is None:
+        return fail_response("A group with this id does not exist.", 404)
+
+    #Verifying session 
+    success, session_token = extract_token_from_header(request)
+    if not success:
+        return fail_response(session_token, 400)
+    user = user_auth.get_user_by_session_token(session_token)
+    if user is None or not user.verify_session_token(session_token):
+        return fail_response("Invalid session token", 400)
+
+    if not (group.admin_id == user.id or is_site_admin(user)):
+        return fail_response("Only the group admin can delete this group", 400)
+
+    deleted = group.serialize_simple()
+    deletion.delete_groups([group.id])
+    db.session.commit()
+
+    return success_response(deleted, 200)
+
+@api.route("/groups/<int:group_id>/requests/", methods = ["POST"])
 def create_request(group_id):
 
     optional_group = Group.query.filter_by(id = group_id).first()
@@ -240,21 +357,22 @@ def create_request(group_id):
     
     #Checking if already member of group, or already created request.
     preexisting_request = Request.query.filter_by(group_id = group_id, user_id = user.id).first()
-    is_admin = (user.id == optional_group.admin_id)
+    is_member = user_auth.is_group_member(user.id, group_id)
 
-    if (not preexisting_request is None) or is_admin:
+    if (not preexisting_request is None) or is_member:
         return fail_response("User is already member of group or has already made request to join.", 400)
 
     new_request = Request(group_id = group_id, user_id = user.id, status = None)
 
     db.session.add(new_request)
+    analytics.bump(optional_group.course_id, request_count = 1)
     db.session.commit()
 
     return success_response(new_request.serialize(), 201)   
 
 
     
-@app.route("/requests/<int:request_id>/", methods = ["POST"])
+@api.route("/requests/<int:request_id>/", methods = ["POST"])
 def accept_deny_request(request_id):
 
     body = json.loads(request.data)
@@ -295,16 +413,18 @@ def accept_deny_request(request_id):
     
     if (response == False):
         join_request.status = False
+        analytics.bump(group.course_id, denied_count = 1)
         db.session.commit()
         return success_response(join_request.serialize(), 200) 
     
     join_request.status = True
     group.users.append(request_maker)
+    analytics.bump(group.course_id, accepted_count = 1, member_count = 1)
     db.session.commit()
     return success_response (join_request.serialize(), 200)
 
 
-@app.route("/groups/<int:group_id>/accepting/", methods = ["POST"])
+@api.route("/groups/<int:group_id>/accepting/", methods = ["POST"])
 def close_open_group(group_id):
 
     body = json.loads(request.data)
@@ -331,13 +451,16 @@ def close_open_group(group_id):
     if not is_admin:
         return fail_response("This requires admin permission.", 400)
     
+    changed = bool(accepting_members) != group.accepting_members
     group.accepting_members = accepting_members
+    if changed:
+        analytics.bump(group.course_id, open_group_count = 1 if accepting_members else -1)
     db.session.commit()
 
     return success_response(group.serialize(), 200)
 
 #Requires membership in group to view requests to group
-@app.route("/groups/<int:group_id>/requests/", methods = ["GET"])
+@api.route("/groups/<int:group_id>/requests/", methods = ["GET"])
 def view_requests(group_id):
 
     group = Group.query.filter_by(id = group_id).first()
@@ -356,17 +479,16 @@ def view_requests(group_id):
         return fail_response("Invalid session token", 400)
     
     #Checking if is member of group
-    preexisting_request = Request.query.filter_by(group_id = group_id, user_id = user.id, status = True).first()
-    is_admin = (user.id == group.admin_id)
-
-    if preexisting_request is None and (not is_admin):
+    if not user_auth.is_group_member(user.id, group_id):
         return fail_response("User is not a member of this group", 400)
 
     requests = [r.serialize() for r in  Request.query.filter_by(group_id = group_id).all()]
+    if include_archived():
+        requests += [r.serialize() for r in archive.archived_requests_for_group(group_id)]
 
     return success_response({"requests": requests}, 200)
 
-@app.route("/requests/<int:request_id>/", methods = ["GET"])
+@api.route("/requests/<int:request_id>/", methods = ["GET"])
 def get_request(request_id):
 
     the_request = Request.query.filter_by(id=request_id).first()
@@ -391,15 +513,12 @@ def get_request(request_id):
         return fail_response("Invalid session token", 400)
     
     #Checking if is member of group
-    preexisting_request = Request.query.filter_by(group_id = group_id, user_id = user.id, status = True).first()
-    is_admin = (user.id == group.admin_id)
-
-    if preexisting_request is None and (not is_admin):
+    if not user_auth.is_group_member(user.id, group_id):
         return fail_response("User is not a member of this group", 400)
     
     return success_response(the_request.serialize(), 200)
 
-@app.route("/groups/<int:group_id>/events/", methods = ["POST"])
+@api.route("/groups/<int:group_id>/events/", methods = ["POST"])
 def create_event(group_id):
 
     group = Group.query.filter_by(id = group_id).first()
@@ -417,6 +536,10 @@ def create_event(group_id):
 
     if year is None or month is None or day is None or hour is None or minute is None or location is None or description is None:
         return fail_response("Missing location, time, or description", 400)
+
+    capacity = body.get("capacity")
+    if capacity is not None and (not isinstance(capacity, int) or isinstance(capacity, bool) or capacity < 1):
+        return fail_response("Capacity must be a positive integer.", 400)
         
 
     #Verifying session 
@@ -428,25 +551,23 @@ def create_event(group_id):
         return fail_response("Invalid session token", 400)
     
     #Checking if is member of group
-    preexisting_request = Request.query.filter_by(group_id = group_id, user_id = user.id, status = True).first()
-    is_admin = (user.id == group.admin_id)
-
-    if preexisting_request is None and (not is_admin):
+    if not user_auth.is_group_member(user.id, group_id):
         return fail_response("User is not a member of this group", 400)
     
     new_event = Event(group_id = group_id, description = description, 
                       location = location, year = year, month = month, day = day,
-                      hour = hour, minute = minute)
+                      hour = hour, minute = minute, capacity = capacity)
 
     new_event.attendees.append(user)
 
     db.session.add(new_event)
+    analytics.bump_event(group.course_id, new_event.time, 1)
     db.session.commit()
 
     return success_response(new_event.serialize(), 201)
 
 
-@app.route("/groups/<int:group_id>/events/", methods = ["GET"])
+@api.route("/groups/<int:group_id>/events/", methods = ["GET"])
 def get_events(group_id):
 
     group = Group.query.filter_by(id = group_id).first()
@@ -462,17 +583,62 @@ def get_events(group_id):
         return fail_response("Invalid session token", 400)
     
     #Checking if is member of group
-    preexisting_request = Request.query.filter_by(group_id = group_id, user_id = user.id, status = True).first()
-    is_admin = (user.id == group.admin_id)
-
-    if preexisting_request is None and (not is_admin):
+    if not user_auth.is_group_member(user.id, group_id):
         return fail_response("User is not a member of this group", 400)
     
     events = [e.serialize() for e in group.events]
+    if include_archived():
+        events += [e.serialize() for e in archive.archived_events_for_group(group_id)]
 
     return success_response({"events": events}, 200)
 
-@app.route("/events/<int:event_id>/", methods = ["GET"])
+@api.route("/groups/<int:group_id>/availability/", methods = ["GET"])
+def get_availability(group_id):
+
+    group = Group.query.filter_by(id = group_id).first()
+    if group is None:
+        return fail_response("No group with this id exists.", 404)
+
+    try:
+        start = datetime.datetime.fromisoformat(request.args.get("from", ""))
+        end = datetime.datetime.fromisoformat(request.args.get("to", ""))
+    except ValueError:
+        return fail_response("Invalid or missing from/to time.", 400)
+    #Event times are stored without an offset, so aware times cannot be compared to them
+    if start.tzinfo is not None or end.tzinfo is not None:
+        return fail_response("from/to must not include a UTC offset.", 400)
+    duration = request.args.get("duration", type = int)
+    #Year 1 is rejected because the sweep subtracts the duration from times near start
+    if (duration is None or duration <= 0 or duration > availability.MAX_DURATION
+            or end <= start or end - start > availability.MAX_RANGE or start.year == datetime.MINYEAR):
+        return fail_response("Invalid duration or time range.", 400)
+    duration = datetime.timedelta(minutes = duration)
+    limit = request.args.get("limit", availability.DEFAULT_LIMIT, type = int)
+
+    #Verifying session 
+    success, session_token = extract_token_from_header(request)
+    if not success:
+        return fail_response(session_token, 400)
+    user = user_auth.get_user_by_session_token(session_token)
+    if user is None or not user.verify_session_token(session_token):
+        return fail_response("Invalid session token", 400)
+    
+    #Checking if is member of group
+    if not user_auth.is_group_member(user.id, group_id):
+        return fail_response("User is not a member of this group", 400)
+
+    busy = availability.member_commitments(group_id, start, end)
+    members = len(group.users)
+    slots = availability.find_slots(busy, start, end, duration, max(1, limit))
+
+    return success_response({"slots": [{
+        "start": str(slot_start),
+        "end": str(slot_start + duration),
+        "busy": clashes,
+        "available": members - clashes
+    } for slot_start, clashes in slots]}, 200)
+
+@api.route("/events/<int:event_id>/", methods = ["GET"])
 def get_event(event_id):
 
     event = Event.query.filter_by(id = event_id).first()
@@ -490,18 +656,15 @@ def get_event(event_id):
         return fail_response("Invalid session token", 400)
     
     #Checking if is member of group
-    preexisting_request = Request.query.filter_by(group_id = group.id, user_id = user.id, status = True).first()
-    is_admin = (user.id == group.admin_id)
-
-    if preexisting_request is None and (not is_admin):
+    if not user_auth.is_group_member(user.id, group.id):
         return fail_response("User is not a member of this group", 400)
     
     return success_response(event.serialize(), 200)
 
-@app.route("/events/<int:event_id>/join/", methods = ["POST"])
+@api.route("/events/<int:event_id>/join/", methods = ["POST"])
 def join_event(event_id):
     event = Event.query.filter_by(id = event_id).first()
-    if event_id is None:
+    if event is None:
         return fail_response("No event with this id exists.", 404)
     
     group = Group.query.filter_by(id = event.group_id).first()
@@ -515,20 +678,45 @@ def join_event(event_id):
         return fail_response("Invalid session token", 400)
     
     #Checking if is member of group
-    preexisting_request = Request.query.filter_by(group_id = group.id, user_id = user.id, status = True).first()
-    is_admin = (user.id == group.admin_id)
-
-    if preexisting_request is None and (not is_admin):
+    if not user_auth.is_group_member(user.id, group.id):
         return fail_response("User is not a member of this group", 400)
     
-    event.attendees.append(user)
+    status = rsvp.join(event, user.id)
     db.session.commit()
+
+    data = event.serialize()
+    data["rsvp"] = status
+    if status == rsvp.WAITLISTED:
+        data["waitlist_position"] = rsvp.waitlist_position(event.id, user.id)
+        return success_response(data, 202)
+    return success_response(data, 200)
+
+@api.route("/events/<int:event_id>/leave/", methods = ["POST"])
+def leave_event(event_id):
+    event = Event.query.filter_by(id = event_id).first()
+    if event is None:
+        return fail_response("No event with this id exists.", 404)
+
+    #Verifying session 
+    success, session_token = extract_token_from_header(request)
+    if not success:
+        return fail_response(session_token, 400)
+    user = user_auth.get_user_by_session_token(session_token)
+    if user is None or not user.verify_session_token(session_token):
+        return fail_response("Invalid session token", 400)
+
+    promoted = rsvp.leave(event, user.id)
+    if promoted is None:
+        db.session.rollback()
+        return fail_response("User is not attending or waitlisted for this event.", 400)
+    db.session.commit()
+
     return success_response(event.serialize(), 200)
 
-@app.route("/events/<int:event_id>/", methods = ["DELETE"])
+@api.route("/events/<int:event_id>/", methods = ["DELETE"])
 def delete_event(event_id):
     event = Event.query.filter_by(id = event_id).first()
-    if event_id is None:
+    if event is None:
         return fail_response("No event with this id exists.", 404)
     
     group = Group.query.filter_by(id = event.group_id).first()
@@ -542,18 +730,17 @@ def delete_event(event_id):
         return fail_response("Invalid session token", 400)
     
     #Checking if is member of group
-    preexisting_request = Request.query.filter_by(group_id = group.id, user_id = user.id, status = True).first()
-    is_admin = (user.id == group.admin_id)
-
-    if preexisting_request is None and (not is_admin):
+    if not user_auth.is_group_member(user.id, group.id):
         return fail_response("User is not a member of this group", 400)
     
-    db.session.delete(event)
+    deleted = event.serialize()
+    deletion.delete_events([event.id])
+    analytics.bump_event(group.course_id, event.time, -1)
     db.session.commit()
     
-    return success_response(event.serialize(), 200)
+    return success_response(deleted, 200)
 
-@app.route("/users/<int:user_id>/events/", methods = ["GET"])
+@api.route("/users/<int:user_id>/events/", methods = ["GET"])
 def get_events_attending(user_id):
     #Verifying session 
     success, session_token = extract_token_from_header(request)
@@ -566,9 +753,12 @@ def get_events_attending(user_id):
     if not (user.id == user_id):
         return fail_response("You do not have permission to view this user's events", 400)
     
-    return success_response({"my_events": [u.serialize() for u in user.events_attending]}, 200)
+    events = [e.serialize() for e in user.events_attending]
+    if include_archived():
+        events += [e.serialize() for e in archive.archived_events_for_user(user_id)]
+    return success_response({"my_events": events}, 200)
 
-@app.route("/users/<int:user_id>/groups/", methods = ["GET"])
+@api.route("/users/<int:user_id>/groups/", methods = ["GET"])
 def get_groups_by_user(user_id):
     #Verifying session 
     success, session_token = extract_token_from_header(request)
@@ -582,9 +772,181 @@ def get_groups_by_user(user_id):
         return fail_response("You do not have permission to view this user's groups list.", 400)
     
     return success_response({"my_groups": [g.serialize() for g in user.groups]}, 200)
+
+@api.route("/me/changes/", methods = ["GET"])
+def get_changes():
+    #Verifying session 
+    success, session_token = extract_token_from_header(request)
+    if not success:
+        return fail_response(session_token, 400)
+    user = user_auth.get_user_by_session_token(session_token)
+    if user is None or not user.verify_session_token(session_token):
+        return fail_response("Invalid session token", 400)
+
+    #No cursor: hand out the current one so the client can start syncing
+    #after fetching the full lists.
+    since = request.args.get("since", type = int)
+    if since is None:
+        return success_response({"changes": [], "cursor": changelog.current_cursor(), "has_more": False}, 200)
+
+    if since < changelog.horizon():
+        return fail_response("Cursor is too old, a full resync is required.", 410)
+
+    limit = request.args.get("limit", changelog.DEFAULT_PAGE_SIZE, type = int)
+    limit = max(1, min(limit, changelog.DEFAULT_PAGE_SIZE))
+    changes = changelog.changes_since(user, since, limit)
+    cursor = changes[-1].id if changes else since
+
+    return success_response({
+        "changes": changelog.serialize_changes(changes),
+        "cursor": cursor,
+        "has_more": len(changes) == limit
+    }, 200)
+
+@api.route("/graphql/", methods = ["POST"], strict_slashes = False)
+def graphql_query():
+    body = json.loads(request.data)
+
+    #Verifying session, if given. Without one only public fields resolve.
+    user = None
+    if request.headers.get("Authorization") is not None:
+        success, session_token = extract_token_from_header(request)
+        if not success:
+            return fail_response(session_token, 400)
+        user = user_auth.get_user_by_session_token(session_token)
+        if user is None or not user.verify_session_token(session_token):
+            return fail_response("Invalid session token", 400)
+
+    #Imported here so graphql-core stays off the startup path of every worker
+    import graphql_api
+    result, code = graphql_api.run_query(
+        body.get("query"), body.get("variables"), body.get("operationName"), user,
+        max_depth = current_app.config.get("GRAPHQL_MAX_DEPTH", graphql_api.DEFAULT_MAX_DEPTH),
+        max_cost = current_app.config.get("GRAPHQL_MAX_COST", graphql_api.DEFAULT_MAX_COST))
+    return success_response(result, code)
+
+@api.route("/analytics/courses/", methods = ["GET"])
+def get_course_analytics():
+    weeks = request.args.get("weeks", analytics.DEFAULT_WEEKS, type = int)
+    if weeks < 1 or weeks > 52:
+        return fail_response("Weeks must be between 1 and 52.", 400)
+    summaries = analytics.course_summaries(weeks)
+    return success_response({"courses": summaries}, 200)
+
+@api.route("/admin/backup/", methods = ["POST"])
+def create_backup():
+    body = json.loads(request.data or "{}")
+    compress = bool(body.get("compress", False))
+    keep = body.get("keep")
+    if keep is not None and (not isinstance(keep, int) or isinstance(keep, bool) or keep < 1):
+        return fail_response("Keep must be a positive integer.", 400)
+
+    #Verifying session 
+    success, session_token = extract_token_from_header(request)
+    if not success:
+        return fail_response(session_token, 400)
+    user = user_auth.get_user_by_session_token(session_token)
+    if user is None or not user.verify_session_token(session_token):
+        return fail_response("Invalid session token", 400)
+
+    if not is_site_admin(user):
+        return fail_response("This requires admin permission.", 400)
+
+    name = g.get("tenant") or tenancy.DEFAULT_NAME
+    backup_dir = current_app.config["BACKUP_DIR"]
+    path = backup.backup(tenancy.current_engine(db), backup_dir, name, compress = compress)
+    pruned = backup.prune(backup_dir, name, keep) if keep is not None else []
+
+    return success_response({
+        "snapshot": os.path.basename(path),
+        "size": os.path.getsize(path),
+        "pruned": [os.path.basename(p) for p in pruned]
+    }, 201)
+
+@api.cli.command("compact-changes")
+@click.option("--days", default = changelog.DEFAULT_RETENTION_DAYS, help = "Days of change log to keep.")
+@click.option("--tenant", default = None, help = "Tenant to compact, default database if omitted.")
+def compact_changes(days, tenant):
+    """Compacts the change log. Meant to be run periodically, e.g. from cron."""
+    with tenancy.use_tenant(tenant):
+        deleted = changelog.compact(days)
+    click.echo("Removed %d change log entries." % deleted)
+
+@api.cli.command("archive")
+@click.option("--days", default = archive.DEFAULT_EVENT_GRACE_DAYS, help = "Archive events more than this many days old.")
+@click.option("--batch-size", default = archive.DEFAULT_BATCH_SIZE, help = "Rows moved per transaction.")
+@click.option("--tenant", default = None, help = "Tenant to archive, default database if omitted.")
+def archive_command(days, batch_size, tenant):
+    """Moves past events and resolved requests into the archive tables."""
+    with tenancy.use_tenant(tenant):
+        events, requests = archive.archive(days, batch_size)
+    click.echo("Archived %d event(s) and %d request(s)." % (events, requests))
+
+@api.cli.command("rebuild-analytics")
+@click.option("--tenant", default = None, help = "Tenant to rebuild, default database if omitted.")
+def rebuild_analytics(tenant):
+    """Recomputes the course analytics summary tables."""
+    with tenancy.use_tenant(tenant):
+        analytics.rebuild()
+        db.session.commit()
+    click.echo("Rebuilt course analytics.")
+
+@api.cli.command("backup")
+@click.option("--tenant", default = None, help = "Tenant to back up, default database if omitted.")
+@click.option("--compress", is_flag = True, help = "Gzip the snapshot (SQLite only).")
+@click.option("--keep", default = None, type = int, help = "Delete all but the newest N snapshots.")
+@click.option("--pages", default = backup.DEFAULT_PAGES_PER_STEP, help = "Pages copied per step (SQLite only).")
+def backup_command(tenant, compress, keep, pages):
+    """Takes an online snapshot without blocking writers."""
+    name = tenant or tenancy.DEFAULT_NAME
+    backup_dir = current_app.config["BACKUP_DIR"]
+    with tenancy.use_tenant(tenant) as engine:
+        path = backup.backup(engine or db.engine, backup_dir, name, compress = compress, pages = pages)
+    click.echo("Wrote %s." % path)
+    if keep is not None:
+        for pruned in backup.prune(backup_dir, name, keep):
+            click.echo("Removed %s." % pruned)
+
+@api.cli.command("restore")
+@click.argument("snapshot")
+@click.option("--tenant", default = None, help = "Tenant to restore, default database if omitted.")
+def restore_command(snapshot, tenant):
+    """Replaces a database with a snapshot. Stop the app first."""
+    with tenancy.use_tenant(tenant) as engine:
+        backup.restore(engine or db.engine, snapshot)
+    click.echo("Restored %s." % snapshot)
+
+@api.cli.command("init-db")
+@click.option("--tenant", default = None, help = "Tenant to initialize, default database if omitted.")
+def init_db(tenant):
+    """Creates missing tables and columns, and backfills course analytics."""
+    with tenancy.use_tenant(tenant) as engine:
+        applied = schema.sync_schema(engine or db.engine)
+        backfilled = analytics.backfill()
+        db.session.commit()
+    click.echo("Applied %d schema change(s)." % len(applied))
+    click.echo("Backfilled analytics of %d course(s)." % backfilled)
+
+@api.cli.command("create-tenant")
+@click.argument("name")
+def create_tenant(name):
+    """Creates a tenant database and its tables."""
+    tenancy.registry().provision(name)
+    click.echo("Created tenant %s." % name)
+
+@api.cli.command("migrate-tenants")
+def migrate_tenants():
+    """Brings every tenant database up to date with the models and backfills course analytics."""
+    for name, applied in tenancy.registry().migrate().items():
+        with tenancy.use_tenant(name):
+            backfilled = analytics.backfill()
+            db.session.commit()
+        click.echo("%s: %d change(s), analytics of %d course(s) backfilled" % (name, len(applied), backfilled))
+        for statement in applied:
+            click.echo("  " + statement)
     
 
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000, debug=True)
\ No newline at end of file
+    create_app({"SQLALCHEMY_ECHO": True, "SCHEMA_AUTO_SYNC": True}).run(host="0.0.0.0", port=8000, debug=True)
\ No newline at end of file
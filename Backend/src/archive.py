@@ -0,0 +1,108 @@
+"""
+Archival
+
+Moves events whose time has passed (with their attendance rows) and resolved
+join requests out of the hot event / request tables into archived_* tables,
+in batches with set-based INSERT ... SELECT / DELETE statements, one
+transaction per batch so writers are never blocked for long.
+
+These are storage moves rather than deletes, so nothing is written to the
+change log: synced clients keep their copy of an archived row.
+"""
+
+import datetime
+
+from sqlalchemy import insert, literal, select
+
+from db import db
+from db import ArchivedEvent
+from db import ArchivedRequest
+from db import Event
+from db import Request
+from db import archived_user_event_association_table
+from db import event_waitlist_table
+from db import user_event_association_table
+
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_EVENT_GRACE_DAYS = 1
+
+
+def _archive_event_batch(ids, now):
+    event = Event.__table__
+    attending = user_event_association_table
+    db.session.execute(insert(ArchivedEvent.__table__).from_select(
+        ["id", "group_id", "description", "location", "time", "capacity", "archived_at"],
+        select(event.c.id, event.c.group_id, event.c.description, event.c.location,
+               event.c.time, event.c.capacity, literal(now, db.DateTime)).where(event.c.id.in_(ids))))
+    db.session.execute(insert(archived_user_event_association_table).from_select(
+        ["user_id", "event_id"],
+        select(attending.c.user_id, attending.c.event_id).where(attending.c.event_id.in_(ids))))
+    db.session.execute(attending.delete().where(attending.c.event_id.in_(ids)))
+    db.session.execute(event_waitlist_table.delete().where(event_waitlist_table.c.event_id.in_(ids)))
+    db.session.execute(event.delete().where(event.c.id.in_(ids)))
+
+
+def _archive_request_batch(ids, now):
+    request = Request.__table__
+    db.session.execute(insert(ArchivedRequest.__table__).from_select(
+        ["id", "group_id", "user_id", "status", "archived_at"],
+        select(request.c.id, request.c.group_id, request.c.user_id, request.c.status,
+               literal(now, db.DateTime)).where(request.c.id.in_(ids))))
+    db.session.execute(request.delete().where(request.c.id.in_(ids)))
+
+
+def _in_batches(select_ids, archive_batch, batch_size):
+    moved = 0
+    while True:
+        ids = [row[0] for row in db.session.execute(select_ids.limit(batch_size))]
+        if not ids:
+            return moved
+        archive_batch(ids, datetime.datetime.now())
+        db.session.commit()
+        moved += len(ids)
+
+
+def archive_events(before, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Archives events that took place before a time
+
+    Returns the number of archived events
+    """
+    select_ids = select(Event.id).where(Event.time < before).order_by(Event.id)
+    return _in_batches(select_ids, _archive_event_batch, batch_size)
+
+
+def archive_requests(batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Archives accepted and denied requests
+
+    Returns the number of archived requests
+    """
+    select_ids = select(Request.id).where(Request.status.isnot(None)).order_by(Request.id)
+    return _in_batches(select_ids, _archive_request_batch, batch_size)
+
+
+def archive(grace_days=DEFAULT_EVENT_GRACE_DAYS, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Archives past events and resolved requests
+
+    Returns (archived events, archived requests)
+    """
+    before = datetime.datetime.now() - datetime.timedelta(days=grace_days)
+    return archive_events(before, batch_size), archive_requests(batch_size)
+
+
+def archived_events_for_group(group_id):
+    return ArchivedEvent.query.filter_by(group_id=group_id).order_by(ArchivedEvent.time).all()
+
+
+def archived_events_for_user(user_id):
+    return ArchivedEvent.query.join(
+        archived_user_event_association_table,
+        archived_user_event_association_table.c.event_id == ArchivedEvent.id
+    ).filter(archived_user_event_association_table.c.user_id == user_id).order_by(ArchivedEvent.time).all()
+
+
+def archived_requests_for_group(group_id):
+    return ArchivedRequest.query.filter_by(group_id=group_id).order_by(ArchivedRequest.id).all()
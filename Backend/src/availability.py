@@ -0,0 +1,107 @@
+"""
+Common free time finder
+
+Suggests start times for a group event that clash with as few members'
+attended events as possible. Every member's commitments are fetched with one
+query, then a sweep line over the interval endpoints finds, for every
+candidate start time, how many members would have a clash.
+"""
+
+import datetime
+from collections import defaultdict
+
+from sqlalchemy import String, select, type_coerce
+
+from db import db
+from db import Event
+from db import user_event_association_table
+from db import user_group_association_table
+
+
+DEFAULT_EVENT_LENGTH = datetime.timedelta(minutes=60)
+DEFAULT_LIMIT = 5
+#Longest slot, in minutes, and widest from/to window a caller may ask for
+MAX_DURATION = 7 * 24 * 60
+MAX_RANGE = datetime.timedelta(days=366)
+
+
+def member_commitments(group_id, start, end, event_length=DEFAULT_EVENT_LENGTH):
+    """
+    Returns {user_id: [(start, end), ...]} for every event attended by a member
+    of the group that overlaps [start, end)
+    """
+    members = user_group_association_table.c
+    attending = user_event_association_table.c
+    #Read the raw column value: SQLite stores datetimes as ISO strings, and
+    #datetime.fromisoformat is much faster than the dialect's DateTime processor
+    query = select(attending.user_id, type_coerce(Event.time, String)).select_from(
+        Event.__table__
+        .join(user_event_association_table, attending.event_id == Event.id)
+        .join(user_group_association_table, members.user_id == attending.user_id)
+    ).where(
+        members.group_id == group_id,
+        Event.time > start - event_length,
+        Event.time < end
+    )
+    busy = defaultdict(list)
+    for user_id, time in db.session.execute(query):
+        if isinstance(time, str):
+            time = datetime.datetime.fromisoformat(time)
+        busy[user_id].append((time, time + event_length))
+    return busy
+
+
+def _merge(intervals):
+    """
+    Merges overlapping intervals, returning them sorted
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start < merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def find_slots(busy, start, end, duration, limit=DEFAULT_LIMIT):
+    """
+    Returns up to `limit` non-overlapping slots of length `duration` inside
+    [start, end), as (slot_start, busy_count) pairs, fewest clashes first.
+
+    A slot starting at t clashes with a commitment [s, e) iff s - duration < t < e,
+    so each member's commitments become "blocked start" intervals. After merging
+    them per member (a member counts once however many events they have) the
+    number of clashing members is piecewise constant between endpoints and is
+    lowest exactly at an endpoint, so only endpoints need to be considered.
+    """
+    latest = end - duration
+    if latest < start:
+        return []
+
+    ends = defaultdict(int)
+    starts = defaultdict(int)
+    for intervals in busy.values():
+        for blocked_start, blocked_end in _merge((s - duration, e) for s, e in intervals):
+            starts[blocked_start] += 1
+            ends[blocked_end] += 1
+
+    candidates = []
+    active = 0
+    for x in sorted(set(starts) | set(ends) | {start}):
+        if x > latest:
+            break
+        active -= ends.get(x, 0)
+        if x >= start:
+            candidates.append((active, x))
+        active += starts.get(x, 0)
+
+    candidates.sort()
+    chosen = []
+    for clashes, slot_start in candidates:
+        if all(abs(slot_start - other) >= duration for other, _ in chosen):
+            chosen.append((slot_start, clashes))
+            if len(chosen) == limit:
+                break
+    return chosen
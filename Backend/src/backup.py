@@ -0,0 +1,148 @@
+"""
+Online backup and restore
+
+SQLite databases are copied with SQLite's online backup API, a few pages per
+step with a short sleep in between, so writers keep going while a snapshot is
+taken. PostgreSQL databases are dumped with pg_dump (custom format, which is
+already compressed) and restored with pg_restore.
+
+Snapshots are named <name>-<UTC timestamp>.<ext> inside BACKUP_DIR, where name
+is the tenant or "default" (a name no tenant can take), so sorting by file
+name sorts by age.
+"""
+
+import datetime
+import gzip
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+
+
+DEFAULT_PAGES_PER_STEP = 256
+DEFAULT_STEP_SLEEP = 0.005
+DEFAULT_KEEP = 7
+
+
+def _timestamp():
+    return datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+
+
+def _is_sqlite(engine):
+    return engine.dialect.name == "sqlite"
+
+
+def _sqlite_connection(engine):
+    """
+    Returns (raw pooled connection, sqlite3 connection) for an engine
+    """
+    if engine.url.database in (None, "", ":memory:"):
+        raise ValueError("In-memory databases cannot be backed up.")
+    raw = engine.raw_connection()
+    return raw, raw.connection
+
+
+def _pg_connection(engine):
+    """
+    Returns (libpq URL without the password, environment with PGPASSWORD) so
+    the password never shows up in the process list
+    """
+    url = engine.url.set(drivername="postgresql", password=None)
+    env = dict(os.environ)
+    if engine.url.password is not None:
+        env["PGPASSWORD"] = str(engine.url.password)
+    return url.render_as_string(hide_password=False), env
+
+
+def snapshots(backup_dir, name):
+    """
+    Returns the snapshot paths for a database, oldest first
+    """
+    if not os.path.isdir(backup_dir):
+        return []
+    pattern = re.compile(r"^%s-\d{8}T\d+\.(db|db\.gz|dump)$" % re.escape(name))
+    return sorted(os.path.join(backup_dir, f) for f in os.listdir(backup_dir) if pattern.match(f))
+
+
+def prune(backup_dir, name, keep=DEFAULT_KEEP):
+    """
+    Deletes all but the newest `keep` snapshots. Returns the deleted paths.
+    """
+    old = snapshots(backup_dir, name)[:-keep] if keep > 0 else snapshots(backup_dir, name)
+    for path in old:
+        os.remove(path)
+    return old
+
+
+def backup(engine, backup_dir, name, compress=False,
+           pages=DEFAULT_PAGES_PER_STEP, sleep=DEFAULT_STEP_SLEEP):
+    """
+    Writes a snapshot of the database behind an engine
+
+    Returns the snapshot path
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    if not _is_sqlite(engine):
+        path = os.path.join(backup_dir, "%s-%s.dump" % (name, _timestamp()))
+        url, env = _pg_connection(engine)
+        subprocess.run(["pg_dump", "--format=custom", "--file", path, url], env=env, check=True)
+        return path
+
+    path = os.path.join(backup_dir, "%s-%s.db" % (name, _timestamp()))
+    #Copy into a temporary file first so a failed backup never leaves a torn snapshot
+    fd, tmp = tempfile.mkstemp(dir=backup_dir, suffix=".tmp")
+    os.close(fd)
+    raw, source = _sqlite_connection(engine)
+    try:
+        target = sqlite3.connect(tmp)
+        try:
+            source.backup(target, pages=pages, sleep=sleep)
+        finally:
+            target.close()
+        if compress:
+            with open(tmp, "rb") as src, gzip.open(tmp + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(tmp)
+            tmp, path = tmp + ".gz", path + ".gz"
+        os.replace(tmp, path)
+    except BaseException:
+        for leftover in (tmp, tmp + ".gz"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+    finally:
+        raw.close()
+    return path
+
+
+def restore(engine, path, pages=DEFAULT_PAGES_PER_STEP):
+    """
+    Replaces the contents of the database behind an engine with a snapshot.
+    Meant to be run with the app stopped.
+    """
+    if not _is_sqlite(engine):
+        url, env = _pg_connection(engine)
+        subprocess.run(["pg_restore", "--clean", "--if-exists", "--dbname", url, path], env=env, check=True)
+        return
+
+    source_path, tmp = path, None
+    if path.endswith(".gz"):
+        fd, tmp = tempfile.mkstemp(suffix=".db")
+        with os.fdopen(fd, "wb") as dst, gzip.open(path, "rb") as src:
+            shutil.copyfileobj(src, dst)
+        source_path = tmp
+    engine.dispose()
+    raw, target = _sqlite_connection(engine)
+    try:
+        source = sqlite3.connect(source_path)
+        try:
+            source.backup(target, pages=pages)
+        finally:
+            source.close()
+    finally:
+        raw.close()
+        if tmp is not None:
+            os.remove(tmp)
+    engine.dispose()
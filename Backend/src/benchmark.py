@@ -0,0 +1,481 @@
+"""
+Benchmarks
+
+Run with `python benchmark.py <name>`, or with no name to list them.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+BENCHMARKS = {}
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def _timeit(fn, repeat=20):
+    """
+    Returns the best wall time of fn in seconds over repeat runs
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _sample_users_payload(n_users=2000, groups_per_user=4):
+    users = []
+    for i in range(n_users):
+        users.append({
+            "id": i,
+            "net_id": "abc%d" % i,
+            "name": "Student %d" % i,
+            "bio": "Studying for prelims",
+            "groups": [{
+                "id": i * groups_per_user + g,
+                "course_id": g,
+                "course_code": "CS %d" % (1110 + g * 100),
+                "admin_id": i,
+                "accepting_members": True
+            } for g in range(groups_per_user)]
+        })
+    return json.dumps({"users": users}).encode("utf8")
+
+
+@benchmark
+def compression():
+    """
+    Bandwidth and CPU per encoding and level for a GET /users/ sized body
+    """
+    import compression as comp
+
+    data = _sample_users_payload()
+    print("raw body: %d bytes" % len(data))
+    print("%-6s %5s %10s %7s %10s" % ("enc", "level", "bytes", "ratio", "ms"))
+    levels = {"gzip": [1, 6, 9], "br": [1, 5, 11], "zstd": [1, 3, 9, 19]}
+    for encoding, compressor in comp.COMPRESSORS.items():
+        for level in levels[encoding]:
+            out = compressor(data, level)
+            seconds = _timeit(lambda: compressor(data, level), repeat=5)
+            print("%-6s %5d %10d %6.1fx %10.2f" % (
+                encoding, level, len(out), len(data) / len(out), seconds * 1000))
+
+    cache = comp.CompressedCache()
+    cache.get_or_compress(data, "gzip", 6)
+    hit = _timeit(lambda: cache.get_or_compress(data, "gzip", 6))
+    print("cached gzip hit: %.3f ms (digest only)" % (hit * 1000))
+
+
+_STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+instance = app.create_app({"SQLALCHEMY_DATABASE_URI": sys.argv[1], "SCHEMA_AUTO_SYNC": sys.argv[2] == "1"})
+created = time.perf_counter()
+instance.test_client().get("/courses/")
+responded = time.perf_counter()
+print(imported - start, created - imported, responded - created)
+"""
+
+#The app before create_app, which ran create_all while being imported
+_BASELINE_STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.app.test_client().get("/courses/")
+responded = time.perf_counter()
+print(imported - start, 0.0, responded - imported)
+"""
+
+
+def _export_baseline(here, tmp):
+    """
+    Extracts the source tree from before create_app was added into tmp and
+    returns its path
+    """
+    def git(*args, cwd=here):
+        return subprocess.run(("git",) + args, cwd=cwd, check=True, capture_output=True,
+                              text=True).stdout.strip()
+    added = git("log", "--reverse", "--format=%H", "-S", "def create_app", "--", "app.py").split()[0]
+    prefix = git("rev-parse", "--show-prefix").rstrip("/")
+    #git archive does not accept a tree path from inside a subdirectory
+    archive = subprocess.run(["git", "archive", "--format=tar", "%s^:%s" % (added, prefix)],
+                             cwd=git("rev-parse", "--show-toplevel"), check=True, capture_output=True).stdout
+    path = os.path.join(tmp, "baseline")
+    os.makedirs(path)
+    subprocess.run(["tar", "-x", "-C", path], input=archive, check=True)
+    return path
+
+
+def _startup_runs(script, cwd, args):
+    runs = []
+    for run_args in args:
+        out = subprocess.run([sys.executable, "-c", script] + run_args, cwd=cwd,
+                             check=True, capture_output=True, text=True).stdout
+        #The baseline app echoes its SQL to stdout; the timings are the last line
+        runs.append([float(x) for x in out.splitlines()[-1].split()])
+    return min(runs, key=sum)
+
+
+@benchmark
+def startup():
+    """
+    Import-to-first-response time of a fresh interpreter
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        baseline = _export_baseline(here, tmp)
+        print("%-24s %9s %9s %9s %9s" % ("", "import", "create", "first", "total"))
+        results = [("baseline (import-time)", _startup_runs(_BASELINE_STARTUP_SCRIPT, baseline, [[]] * 5))]
+        cases = (("new db, auto sync", "1", True), ("existing db, auto sync", "1", False),
+                 ("existing db, no sync", "0", False))
+        for label, sync, fresh in cases:
+            args = [["sqlite:///%s" % os.path.join(tmp, "%s-%d.db" % (sync, i) if fresh else "existing.db"), sync]
+                    for i in range(5)]
+            results.append((label, _startup_runs(_STARTUP_SCRIPT, here, args)))
+        base = sum(results[0][1])
+        for label, best in results:
+            print("%-24s %8.1fms %8.1fms %8.1fms %8.1fms %6.0f%%" % (
+                (label,) + tuple(x * 1000 for x in best) + (sum(best) * 1000, sum(best) / base * 100)))
+
+
+def _seed_group(db, n_members, events_per_member, start):
+    """
+    Inserts one group with n_members members who each attend events_per_member
+    events spread over the 30 days after start. Returns (group_id, session_token).
+    """
+    import datetime
+    import random
+    from db import Course, Event, Group, User
+    from db import user_event_association_table, user_group_association_table
+
+    rng = random.Random(42)
+    expires = datetime.datetime.now() + datetime.timedelta(days=1)
+    db.session.execute(User.__table__.insert(), [{
+        "id": i, "net_id": "m%d" % i, "name": "Member %d" % i, "bio": "", "password_digest": "x",
+        "session_token": "s%d" % i, "session_expiration": expires, "update_token": "u%d" % i
+    } for i in range(1, n_members + 1)])
+    db.session.execute(Course.__table__.insert(), [{"id": 1, "course_title": "Bench", "course_code": "B 1"}])
+    db.session.execute(Group.__table__.insert(), [{"id": 1, "course_id": 1, "admin_id": 1, "accepting_members": True}])
+    db.session.execute(user_group_association_table.insert(),
+                       [{"user_id": i, "group_id": 1} for i in range(1, n_members + 1)])
+    events, attending = [], []
+    for i in range(1, n_members + 1):
+        for _ in range(events_per_member):
+            events.append({"id": len(events) + 1, "group_id": 1, "description": "", "location": "",
+                           "time": start + datetime.timedelta(minutes=15 * rng.randrange(30 * 24 * 4))})
+            attending.append({"user_id": i, "event_id": len(events)})
+    if events:
+        db.session.execute(Event.__table__.insert(), events)
+        db.session.execute(user_event_association_table.insert(), attending)
+    db.session.commit()
+    return 1, "s1"
+
+
+@benchmark
+def availability():
+    """
+    Free-time search for a 50 member group with 300 events per member
+    """
+    import datetime
+    import app as application
+    import availability as avail
+    from db import db
+
+    start = datetime.datetime(2026, 1, 5, 8)
+    end = start + datetime.timedelta(days=30)
+    duration = datetime.timedelta(minutes=90)
+    with tempfile.TemporaryDirectory() as tmp:
+        instance = application.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///%s/bench.db" % tmp})
+        with instance.app_context():
+            db.create_all()
+            group_id, token = _seed_group(db, 50, 300, start)
+            query = _timeit(lambda: avail.member_commitments(group_id, start, end))
+            busy = avail.member_commitments(group_id, start, end)
+            sweep = _timeit(lambda: avail.find_slots(busy, start, end, duration))
+        client = instance.test_client()
+        url = "/groups/%d/availability/?from=%s&to=%s&duration=90" % (
+            group_id, start.isoformat(), end.isoformat())
+        headers = {"Authorization": "Bearer " + token}
+        client.get(url, headers=headers)
+        request = _timeit(lambda: client.get(url, headers=headers))
+    print("commitments: %d events" % sum(len(v) for v in busy.values()))
+    print("query:       %.1f ms" % (query * 1000))
+    print("sweep:       %.1f ms" % (sweep * 1000))
+    print("request:     %.1f ms" % (request * 1000))
+
+
+@benchmark
+def read_model():
+    """
+    Memory and rebuild time of the read model for 100k groups
+    """
+    import datetime
+    import gc
+    import tracemalloc
+    import app as application
+    import read_model as rm
+    from db import db, Course, Group, User, user_group_association_table
+
+    n_courses, n_groups, n_users, members_per_group = 5000, 100000, 50000, 4
+    expires = datetime.datetime.now() + datetime.timedelta(days=1)
+    with tempfile.TemporaryDirectory() as tmp:
+        instance = application.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///%s/bench.db" % tmp})
+        with instance.app_context():
+            db.create_all()
+            db.session.execute(User.__table__.insert(), [{
+                "id": i, "net_id": "n%d" % i, "name": "Student %d" % i, "bio": "", "password_digest": "x",
+                "session_token": "s%d" % i, "session_expiration": expires, "update_token": "u%d" % i
+            } for i in range(1, n_users + 1)])
+            db.session.execute(Course.__table__.insert(), [
+                {"id": i, "course_title": "Course %d" % i, "course_code": "C %d" % i}
+                for i in range(1, n_courses + 1)])
+            db.session.execute(Group.__table__.insert(), [
+                {"id": i, "course_id": i % n_courses + 1, "admin_id": i % n_users + 1, "accepting_members": True}
+                for i in range(1, n_groups + 1)])
+            db.session.execute(user_group_association_table.insert(), [
+                {"group_id": i, "user_id": (i * 7 + k) % n_users + 1}
+                for i in range(1, n_groups + 1) for k in range(members_per_group)])
+            db.session.commit()
+
+            snapshot = rm.Snapshot(db.engine)
+            start = time.perf_counter()
+            snapshot.rebuild()
+            rebuild = time.perf_counter() - start
+            del snapshot
+
+            gc.collect()
+            tracemalloc.start()
+            snapshot = rm.Snapshot(db.engine)
+            snapshot.rebuild()
+            gc.collect()
+            snapshot_bytes = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            serialize = _timeit(lambda: snapshot.get_group(n_groups // 2), repeat=1000)
+
+            gc.collect()
+            tracemalloc.start()
+            groups = Group.query.all()
+            orm_bytes = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del groups
+            db.session.remove()
+
+    print("groups: %d, memberships: %d, users: %d" % (n_groups, n_groups * members_per_group, n_users))
+    print("snapshot rebuild:         %.2f s" % rebuild)
+    print("snapshot memory:          %.1f MB" % (snapshot_bytes / 2 ** 20))
+    print("ORM Group objects only:   %.1f MB" % (orm_bytes / 2 ** 20))
+    print("GET /groups/<id>/ body:   %.1f us" % (serialize * 10 ** 6))
+
+
+@benchmark
+def rsvp():
+    """
+    Concurrency stress test: parallel joins and leaves against one event
+    """
+    import datetime
+    import threading
+    import app as application
+    from db import db, Event, event_waitlist_table, user_event_association_table
+
+    n_members, capacity, clicks = 40, 10, 3
+    with tempfile.TemporaryDirectory() as tmp:
+        instance = application.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///%s/bench.db" % tmp})
+        with instance.app_context():
+            db.create_all()
+            start = datetime.datetime(2030, 1, 1)
+            _seed_group(db, n_members, 0, start)
+            db.session.execute(Event.__table__.insert(), [{
+                "id": 1, "group_id": 1, "description": "", "location": "", "time": start, "capacity": capacity}])
+            db.session.commit()
+
+        barrier = threading.Barrier(n_members)
+        statuses, errors = [], []
+
+        def member(i):
+            client = instance.test_client()
+            headers = {"Authorization": "Bearer s%d" % i}
+            barrier.wait()
+            for _ in range(clicks):
+                response = client.post("/events/1/join/", headers=headers)
+                (statuses if response.status_code in (200, 202) else errors).append(response.status_code)
+            if i % 4 == 0:
+                response = client.post("/events/1/leave/", headers=headers)
+                (statuses if response.status_code == 200 else errors).append(response.status_code)
+
+        threads = [threading.Thread(target=member, args=(i,)) for i in range(1, n_members + 1)]
+        begin = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - begin
+
+        with instance.app_context():
+            attending = db.session.execute(user_event_association_table.select()).all()
+            waitlisted = db.session.execute(event_waitlist_table.select()).all()
+        pairs = [(r.user_id, r.event_id) for r in attending]
+        waiting = {r.user_id for r in waitlisted}
+
+    print("%d members x %d clicks, capacity %d, every 4th member leaves" % (n_members, clicks, capacity))
+    print("requests: %d ok, %d failed in %.2f s" % (len(statuses), len(errors), elapsed))
+    print("attending: %d (distinct %d), waitlisted: %d" % (len(pairs), len(set(pairs)), len(waiting)))
+    print("attending and waitlisted at once: %d" % len(waiting & {u for u, _ in pairs}))
+    ok = (len(pairs) == len(set(pairs)) and len(pairs) <= capacity and not errors
+          and not waiting & {u for u, _ in pairs})
+    print("OK" if ok else "FAILED")
+    if not ok:
+        sys.exit(1)
+
+
+def _seed_course(db, n_groups, members_per_group=5, events_per_group=5, requests_per_group=2):
+    """
+    Inserts course 1 with n_groups groups, each with members, events attended
+    by three members and pending requests from non-members
+    """
+    import datetime
+    from db import Course, Event, Group, Request, User
+    from db import user_event_association_table, user_group_association_table
+
+    n_users = n_groups * members_per_group + requests_per_group
+    start = datetime.datetime(2030, 1, 1)
+    db.session.execute(User.__table__.insert(), [{
+        "id": i, "net_id": "n%d" % i, "name": "Student %d" % i, "bio": "", "password_digest": "x",
+        "session_token": "s%d" % i, "session_expiration": start, "update_token": "u%d" % i
+    } for i in range(1, n_users + 1)])
+    db.session.execute(Course.__table__.insert(), [{"id": 1, "course_title": "Bench", "course_code": "B 1"}])
+    groups, members, events, attending, requests = [], [], [], [], []
+    for g in range(1, n_groups + 1):
+        member_ids = [(g - 1) * members_per_group + k + 1 for k in range(members_per_group)]
+        groups.append({"id": g, "course_id": 1, "admin_id": member_ids[0], "accepting_members": True})
+        members.extend({"user_id": u, "group_id": g} for u in member_ids)
+        for _ in range(events_per_group):
+            events.append({"id": len(events) + 1, "group_id": g, "description": "", "location": "",
+                           "time": start + datetime.timedelta(hours=len(events))})
+            attending.extend({"user_id": u, "event_id": len(events)} for u in member_ids[:3])
+        requests.extend({"group_id": g, "user_id": n_users - k, "status": None} for k in range(requests_per_group))
+    db.session.execute(Group.__table__.insert(), groups)
+    db.session.execute(user_group_association_table.insert(), members)
+    db.session.execute(Event.__table__.insert(), events)
+    db.session.execute(user_event_association_table.insert(), attending)
+    db.session.execute(Request.__table__.insert(), requests)
+    db.session.commit()
+    return len(groups), len(members), len(events), len(attending), len(requests)
+
+
+@benchmark
+def course_delete():
+    """
+    Deleting a course with 1k groups: cascading foreign keys vs loading every row
+    """
+    import shutil
+    import app as application
+    import deletion
+    from db import db, Course, user_event_association_table, user_group_association_table
+
+    def orm_delete():
+        #What the ORM cascade did: load every child and delete it row by row
+        course = Course.query.filter_by(id = 1).first()
+        with db.session.no_autoflush:
+            for group in course.groups:
+                group.users.clear()
+                for event in group.events:
+                    event.attendees.clear()
+                    db.session.delete(event)
+                for request in group.requests:
+                    db.session.delete(request)
+                db.session.delete(group)
+            db.session.delete(course)
+
+    def set_based_delete():
+        deletion.delete_course(1)
+
+    #Second case forces the explicit bottom-up deletes used on databases without cascades
+    cases = (("ON DELETE CASCADE", True, set_based_delete),
+             ("explicit (legacy schema)", False, set_based_delete),
+             ("ORM load and delete", True, orm_delete))
+    with tempfile.TemporaryDirectory() as tmp:
+        seeded = os.path.join(tmp, "seeded.db")
+        instance = application.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + seeded})
+        with instance.app_context():
+            db.create_all()
+            counts = _seed_course(db, 1000)
+            db.engine.dispose()
+        print("groups: %d, memberships: %d, events: %d, attendance: %d, requests: %d" % counts)
+
+        for label, cascade, delete in cases:
+            path = os.path.join(tmp, "run.db")
+            shutil.copy(seeded, path)
+            instance = application.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + path})
+            with instance.app_context():
+                deletion._cascades[db.engine] = cascade
+                start = time.perf_counter()
+                delete()
+                db.session.commit()
+                elapsed = time.perf_counter() - start
+                left = sum(db.session.execute(db.select(db.func.count()).select_from(t)).scalar()
+                           for t in (user_group_association_table, user_event_association_table))
+                db.session.remove()
+                db.engine.dispose()
+            print("%-26s %8.1f ms  (%d association rows left)" % (label, elapsed * 1000, left))
+
+
+@benchmark
+def graphql():
+    """
+    SQL statements and time of a nested GraphQL query vs the REST route
+    """
+    import app as application
+    from db import db
+    from sqlalchemy import event
+
+    query = '{ groups(course_code: "B 1") { id course_code admin { net_id } users { id net_id name bio } } }'
+    with tempfile.TemporaryDirectory() as tmp:
+        instance = application.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///%s/bench.db" % tmp})
+        with instance.app_context():
+            db.create_all()
+            _seed_course(db, 1000)
+            statements = []
+            event.listen(db.engine, "before_cursor_execute",
+                         lambda conn, cursor, statement, *args: statements.append(statement))
+        client = instance.test_client()
+        cases = (("REST GET /groups/", lambda: client.get("/groups/", data=json.dumps({"course_code": "B 1"}))),
+                 ("GraphQL", lambda: client.post("/graphql/", data=json.dumps({"query": query}))))
+        print("1000 groups x 5 members: id, course_code, admin, users")
+        for label, run in cases:
+            run()
+            del statements[:]
+            response = run()
+            count = len(statements)
+            seconds = _timeit(run, repeat=5)
+            print("%-20s %5d statements %8.1f ms  %s" % (label, count, seconds * 1000, response.status_code))
+        #Aliases repeat an introspection selection; the cost limit must reject it before it runs
+        nested = '__type(name: "Group") { fields { type { ofType { ofType { fields { name } } } } } }'
+        aliased = "{ %s }" % " ".join("t%d: %s" % (i, nested) for i in range(300))
+        start = time.perf_counter()
+        response = client.post("/graphql/", data=json.dumps({"query": aliased}))
+        print("%-20s %8.1f ms  %s  %d bytes" % ("300 aliased __type", (time.perf_counter() - start) * 1000,
+                                              response.status_code, len(response.data)))
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in BENCHMARKS:
+        for name, fn in BENCHMARKS.items():
+            print("%-14s %s" % (name, fn.__doc__.strip()))
+        return
+    BENCHMARKS[argv[1]]()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
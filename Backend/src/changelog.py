@@ -0,0 +1,209 @@
+"""
+Change log
+
+Appends a row to the change table for every insert, update and delete of a
+Group, Event or Request, and for every membership / attendance row added or
+removed through Group.users and Event.attendees. Rows are written in the same
+transaction as the change itself, from the session's after_flush event.
+Groups are deleted with deletion.delete_groups / delete_course, which write
+their delete rows (including one per member) before the rows disappear, so
+ORM deletes of a Group are not logged here.
+
+Clients sync with GET /me/changes/?since=<cursor>. Inserts and updates should
+be treated as upserts, since compaction may collapse an insert into a later
+update.
+"""
+
+import datetime
+
+from sqlalchemy import event, func, or_
+from sqlalchemy.orm import attributes
+
+from db import db
+from db import Change
+from db import ChangeCompaction
+from db import Event
+from db import Group
+from db import Request
+from db import user_group_association_table
+
+
+INSERT = "insert"
+UPDATE = "update"
+DELETE = "delete"
+
+DEFAULT_PAGE_SIZE = 500
+DEFAULT_RETENTION_DAYS = 30
+
+
+def _row(entity, entity_id, op, group_id=None, user_id=None):
+    return {
+        "entity": entity,
+        "entity_id": entity_id,
+        "op": op,
+        "group_id": group_id,
+        "user_id": user_id,
+        "created_at": datetime.datetime.now()
+    }
+
+
+def _collection_rows(entity, obj, key, group_id):
+    """
+    Rows for users added to / removed from a many-to-many collection
+    """
+    rows = []
+    history = attributes.get_history(obj, key)
+    for user in history.added:
+        rows.append(_row(entity, obj.id, INSERT, group_id, user.id))
+    for user in history.deleted:
+        rows.append(_row(entity, obj.id, DELETE, group_id, user.id))
+    return rows
+
+
+def _object_rows(obj, op):
+    if isinstance(obj, Group):
+        if op == DELETE:
+            return []
+        rows = [_row("group", obj.id, op, obj.id)]
+        rows.extend(_collection_rows("membership", obj, "users", obj.id))
+        return rows
+    if isinstance(obj, Event):
+        rows = [_row("event", obj.id, op, obj.group_id)]
+        if op != DELETE:
+            rows.extend(_collection_rows("attendance", obj, "attendees", obj.group_id))
+        return rows
+    if isinstance(obj, Request):
+        return [_row("request", obj.id, op, obj.group_id, obj.user_id)]
+    return []
+
+
+def collect_changes(session):
+    """
+    Returns change rows for everything pending in a flushing session
+    """
+    rows = []
+    for obj in session.new:
+        rows.extend(_object_rows(obj, INSERT))
+    for obj in session.dirty:
+        if isinstance(obj, (Group, Event)):
+            if session.is_modified(obj, include_collections=False):
+                rows.extend(_object_rows(obj, UPDATE))
+            else:
+                #Only the membership / attendance collection changed
+                rows.extend(r for r in _object_rows(obj, UPDATE) if r["entity"] not in ("group", "event"))
+        elif isinstance(obj, Request) and session.is_modified(obj):
+            rows.extend(_object_rows(obj, UPDATE))
+    for obj in session.deleted:
+        rows.extend(_object_rows(obj, DELETE))
+    return rows
+
+
+def attendance_rows(event_id, group_id, user_ids, op):
+    """
+    Rows for attendance changes made without the ORM
+    """
+    return [_row("attendance", event_id, op, group_id, user_id) for user_id in user_ids]
+
+
+def record(session, rows):
+    """
+    Appends change rows using the session's current connection
+    """
+    if rows:
+        session.connection().execute(Change.__table__.insert(), rows)
+
+
+@event.listens_for(db.session, "after_flush")
+def _after_flush(session, flush_context):
+    record(session, collect_changes(session))
+
+
+def current_cursor():
+    """
+    Returns the newest cursor in the log, or the compaction horizon if the
+    log is empty
+    """
+    newest = db.session.query(func.coalesce(func.max(Change.id), 0)).scalar()
+    return max(newest, horizon())
+
+
+def horizon():
+    """
+    Returns the oldest cursor that can still be served incrementally
+    """
+    return db.session.query(func.coalesce(func.max(ChangeCompaction.horizon), 0)).scalar()
+
+
+def changes_since(user, since, limit=DEFAULT_PAGE_SIZE):
+    """
+    Returns the change rows after a cursor that are visible to a user, oldest first
+    """
+    member_of = db.session.query(user_group_association_table.c.group_id).filter(
+        user_group_association_table.c.user_id == user.id)
+    return Change.query.filter(
+        Change.id > since,
+        or_(Change.group_id.in_(member_of), Change.user_id == user.id)
+    ).order_by(Change.id).limit(limit).all()
+
+
+def _latest(changes):
+    """
+    Keeps only the newest change per entity, in cursor order
+    """
+    latest = {}
+    for change in changes:
+        latest[(change.entity, change.entity_id, change.user_id)] = change
+    return sorted(latest.values(), key=lambda c: c.id)
+
+
+def _load(model, changes, entity):
+    ids = {c.entity_id for c in changes if c.entity == entity and c.op != DELETE}
+    if not ids:
+        return {}
+    return {o.id: o for o in model.query.filter(model.id.in_(ids)).all()}
+
+
+def serialize_changes(changes):
+    """
+    Serializes changes with the current state of each changed row, loading
+    each entity type with one query
+    """
+    changes = _latest(changes)
+    groups = _load(Group, changes, "group")
+    events = _load(Event, changes, "event")
+    requests = _load(Request, changes, "request")
+    loaded = {"group": groups, "event": events, "request": requests}
+
+    out = []
+    for change in changes:
+        data = change.serialize()
+        obj = loaded.get(change.entity, {}).get(change.entity_id)
+        if obj is not None:
+            data["data"] = obj.serialize() if change.entity == "request" else obj.serialize_simple()
+        elif change.entity in loaded and change.op != DELETE:
+            #Deleted again before the client asked; report the final state
+            data["op"] = DELETE
+        out.append(data)
+    return out
+
+
+def compact(retention_days=DEFAULT_RETENTION_DAYS):
+    """
+    Drops log entries older than the retention window and collapses entries
+    superseded by a newer change to the same entity.
+
+    Returns the number of deleted entries
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+    new_horizon = db.session.query(func.max(Change.id)).filter(Change.created_at < cutoff).scalar()
+
+    deleted = 0
+    if new_horizon is not None:
+        deleted += Change.query.filter(Change.id <= new_horizon).delete(synchronize_session=False)
+        db.session.add(ChangeCompaction(horizon=new_horizon, compacted_at=datetime.datetime.now()))
+
+    newest = db.session.query(func.max(Change.id)).group_by(
+        Change.entity, Change.entity_id, Change.user_id)
+    deleted += Change.query.filter(Change.id.notin_(newest)).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
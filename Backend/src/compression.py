@@ -0,0 +1,161 @@
+"""
+Response compression
+
+Negotiates gzip/brotli/zstd against the client's Accept-Encoding header and
+compresses large JSON bodies. Compressed variants are cached by body digest so
+a body that is served repeatedly (e.g. an unchanged course list) is only
+compressed once per encoding.
+"""
+
+import gzip
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_LEVEL = 6
+DEFAULT_CACHE_ENTRIES = 256
+
+
+def _gzip(data, level):
+    return gzip.compress(data, compresslevel=max(1, min(level, 9)), mtime=0)
+
+
+def _brotli(data, level):
+    return brotli.compress(data, quality=max(0, min(level, 11)))
+
+
+def _zstd(data, level):
+    return zstandard.ZstdCompressor(level=max(1, min(level, 22))).compress(data)
+
+
+#Server preference order, best ratio first
+COMPRESSORS = OrderedDict()
+if zstandard is not None:
+    COMPRESSORS["zstd"] = _zstd
+if brotli is not None:
+    COMPRESSORS["br"] = _brotli
+COMPRESSORS["gzip"] = _gzip
+
+
+def parse_accept_encoding(header):
+    """
+    Returns a dict of encoding -> q-value from an Accept-Encoding header
+    """
+    accepted = {}
+    if not header:
+        return accepted
+    for part in header.split(","):
+        fields = part.strip().split(";")
+        coding = fields[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def choose_encoding(header, available=None):
+    """
+    Picks the best encoding the client accepts, or None for identity
+    """
+    available = COMPRESSORS if available is None else available
+    accepted = parse_accept_encoding(header)
+    best, best_q = None, 0.0
+    for coding in available:
+        q = accepted.get(coding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class CompressedCache:
+    """
+    Small LRU cache of compressed bodies keyed by (digest, encoding, level)
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get_or_compress(self, data, encoding, level):
+        key = (hashlib.sha1(data).digest(), encoding, level)
+        with self._lock:
+            compressed = self._entries.get(key)
+            if compressed is not None:
+                self._entries.move_to_end(key)
+                return compressed
+        compressed = COMPRESSORS[encoding](data, level)
+        with self._lock:
+            self._entries[key] = compressed
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return compressed
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def init_app(app):
+    """
+    Registers the compression hook on a Flask app
+    """
+    app.config.setdefault("COMPRESSION_MIN_SIZE", DEFAULT_MIN_SIZE)
+    app.config.setdefault("COMPRESSION_LEVEL", DEFAULT_LEVEL)
+    app.config.setdefault("COMPRESSION_CACHE_ENTRIES", DEFAULT_CACHE_ENTRIES)
+    cache = CompressedCache(app.config["COMPRESSION_CACHE_ENTRIES"])
+    app.extensions["compression_cache"] = cache
+
+    @app.after_request
+    def compress_response(response):
+        return compress(response, app.config, cache)
+
+
+def compress(response, config, cache):
+    """
+    Compresses a response in place if the client accepts it and it is large enough
+    """
+    if (response.status_code < 200 or response.status_code >= 300
+            or response.direct_passthrough
+            or "Content-Encoding" in response.headers):
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    data = response.get_data()
+    if len(data) < config["COMPRESSION_MIN_SIZE"]:
+        return response
+
+    encoding = choose_encoding(request.headers.get("Accept-Encoding", ""))
+    if encoding is None:
+        return response
+
+    compressed = cache.get_or_compress(data, encoding, config["COMPRESSION_LEVEL"])
+    if len(compressed) >= len(data):
+        return response
+
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    return response
@@ -1,22 +1,71 @@
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 import datetime
 import hashlib
 import bcrypt
 import os
+import sqlite3
 
 
 
-db = SQLAlchemy()
+class TenantSession(Session):
+   """
+   Session that sends every statement to the current request's tenant
+   database, if one was resolved, and to the default database otherwise.
+   """
+
+   def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+      if bind is None and has_app_context():
+         engine = g.get("tenant_engine")
+         if engine is not None:
+            return engine
+      return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={"class_": TenantSession})
+
+
+@event.listens_for(Engine, "connect")
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+   """
+   SQLite only enforces foreign keys (and ON DELETE CASCADE) when asked to,
+   once per connection.
+   """
+   if isinstance(dbapi_connection, sqlite3.Connection):
+      cursor = dbapi_connection.cursor()
+      cursor.execute("PRAGMA foreign_keys=ON")
+      cursor.close()
 
 
 user_group_association_table = db.Table("user_group_assoc", 
-  db.Column("user_id", db.Integer, db.ForeignKey("user.id")),
-  db.Column("group_id", db.Integer, db.ForeignKey("group.id"))
+  db.Column("user_id", db.Integer, db.ForeignKey("user.id", ondelete = "CASCADE")),
+  db.Column("group_id", db.Integer, db.ForeignKey("group.id", ondelete = "CASCADE")),
+  db.Index("ix_user_group_assoc_group_id_user_id", "group_id", "user_id")
 )
 
 user_event_association_table = db.Table("user_event_assoc",
-  db.Column("user_id", db.Integer, db.ForeignKey("user.id")),
-  db.Column("event_id", db.Integer, db.ForeignKey("event.id"))
+  db.Column("user_id", db.Integer, db.ForeignKey("user.id", ondelete = "CASCADE")),
+  db.Column("event_id", db.Integer, db.ForeignKey("event.id", ondelete = "CASCADE")),
+  db.Index("uq_user_event_assoc_user_id_event_id", "user_id", "event_id", unique = True,
+           info = {"dedupe": True}),
+  db.Index("ix_user_event_assoc_event_id", "event_id")
+)
+
+event_waitlist_table = db.Table("event_waitlist",
+  db.Column("id", db.Integer, primary_key = True, autoincrement = True),
+  db.Column("event_id", db.Integer, db.ForeignKey("event.id", ondelete = "CASCADE"), nullable = False),
+  db.Column("user_id", db.Integer, db.ForeignKey("user.id", ondelete = "CASCADE"), nullable = False),
+  db.Index("ix_event_waitlist_event_id_user_id", "event_id", "user_id", unique = True)
+)
+
+archived_user_event_association_table = db.Table("archived_user_event_assoc",
+  db.Column("user_id", db.Integer, db.ForeignKey("user.id", ondelete = "CASCADE")),
+  db.Column("event_id", db.Integer, db.ForeignKey("archived_event.id", ondelete = "CASCADE")),
+  db.Index("ix_archived_user_event_assoc_event_id", "event_id"),
+  db.Index("ix_archived_user_event_assoc_user_id", "user_id")
 )
 
 #MODELS
@@ -115,7 +164,7 @@ class Course(db.Model):
    id = db.Column(db.Integer, primary_key = True, autoincrement = True)
    course_title = db.Column(db.String, nullable = False)
    course_code = db.Column(db.String, nullable = False, unique = True)
-   groups = db.relationship("Group", cascade = "delete")
+   groups = db.relationship("Group", cascade = "delete", passive_deletes = True)
    
    def __init__(self, **kwargs):
        self.course_title = kwargs.get("course_title")
@@ -142,12 +191,12 @@ class Group(db.Model):
     __tablename__ = "group"
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
     users = db.relationship("User", secondary= user_group_association_table,
-                             back_populates="groups")
-    course_id = db.Column(db.Integer, db.ForeignKey("course.id"), nullable = False)
+                             back_populates="groups", passive_deletes = True)
+    course_id = db.Column(db.Integer, db.ForeignKey("course.id", ondelete = "CASCADE"), nullable = False, index = True)
     accepting_members = db.Column(db.Boolean, nullable = False)
     admin_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable = False)
-    events = db.relationship("Event", cascade = "delete")
-    requests = db.relationship("Request", cascade = "delete")
+    events = db.relationship("Event", cascade = "delete", passive_deletes = True)
+    requests = db.relationship("Request", cascade = "delete", passive_deletes = True)
     
     def __init__(self, **kwargs):
       self.course_id = kwargs.get("course_id")
@@ -189,19 +238,24 @@ class Event(db.Model):
     Event object.
     """    
     __tablename__ = "event"    
+    #Ids are never reused, so archived events keep a unique id. archive_table
+    #tells schema.py which ids a migrated id sequence has to start above.
+    __table_args__ = {"sqlite_autoincrement": True, "info": {"archive_table": "archived_event"}}
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    group_id = db.Column(db.Integer, db.ForeignKey("group.id"), nullable = False)    
+    group_id = db.Column(db.Integer, db.ForeignKey("group.id", ondelete = "CASCADE"), nullable = False, index = True)    
     description = db.Column(db.String, nullable=False)
     location = db.Column(db.String, nullable=False)        
     time = db.Column(db.DateTime, nullable=False)    
+    capacity = db.Column(db.Integer, nullable=True)
     attendees = db.relationship("User", secondary= user_event_association_table,
-                             back_populates="events_attending")
+                             back_populates="events_attending", passive_deletes = True)
 
     def __init__(self, **kwargs):
         """
         Initialize an Event object.
         """
         self.group_id = kwargs.get("group_id")
+        self.capacity = kwargs.get("capacity")
         self.description = kwargs.get("description", "")
         self.location = kwargs.get("location", "")
         year = kwargs.get("year")
@@ -221,6 +275,7 @@ class Event(db.Model):
             "description": self.description,
             "location": self.location,
             "time": str(self.time),
+            "capacity": self.capacity,
             "attendees": [u.serialize_simple() for u in self.attendees]
         }
     def serialize_simple(self):
@@ -236,9 +291,13 @@ class Request(db.Model):
     Request object.
     """    
     __tablename__ = "request"    
+    __table_args__ = (
+        db.Index("ix_request_group_id_user_id", "group_id", "user_id"),
+        {"sqlite_autoincrement": True, "info": {"archive_table": "archived_request"}}
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    group_id = db.Column(db.Integer, db.ForeignKey("group.id"), nullable = False)    
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    group_id = db.Column(db.Integer, db.ForeignKey("group.id", ondelete = "CASCADE"), nullable = False)    
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete = "CASCADE"), nullable=False)
     status = db.Column(db.Boolean, nullable=True)        
 
 
@@ -259,4 +318,119 @@ class Request(db.Model):
             "id": self.id,
             "user": user.serialize_simple(),
             "status": self.status
-        }
\ No newline at end of file
+        }
+
+class ArchivedEvent(db.Model):
+    """
+    Event whose time has passed, moved out of the event table.
+    """
+    __tablename__ = "archived_event"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    group_id = db.Column(db.Integer, nullable=False, index=True)
+    description = db.Column(db.String, nullable=False)
+    location = db.Column(db.String, nullable=False)
+    time = db.Column(db.DateTime, nullable=False)
+    capacity = db.Column(db.Integer, nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=False)
+    attendees = db.relationship("User", secondary=archived_user_event_association_table)
+
+    def serialize(self):
+        """
+        Serialize an ArchivedEvent object. Same shape as Event.serialize.
+        """
+        return {
+            "id": self.id,
+            "description": self.description,
+            "location": self.location,
+            "time": str(self.time),
+            "capacity": self.capacity,
+            "attendees": [u.serialize_simple() for u in self.attendees],
+            "archived": True
+        }
+
+class ArchivedRequest(db.Model):
+    """
+    Accepted or denied request, moved out of the request table.
+    """
+    __tablename__ = "archived_request"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    group_id = db.Column(db.Integer, nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    status = db.Column(db.Boolean, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False)
+
+    def serialize(self):
+        """
+        Serialize an ArchivedRequest object. Same shape as Request.serialize.
+        """
+        user = User.query.filter_by(id=self.user_id).first()
+        return {
+            "id": self.id,
+            "user": user.serialize_simple(),
+            "status": self.status,
+            "archived": True
+        }
+
+class CourseStats(db.Model):
+    """
+    Per-course activity counters, maintained incrementally by the write routes.
+    """
+    __tablename__ = "course_stats"
+    course_id = db.Column(db.Integer, db.ForeignKey("course.id", ondelete="CASCADE"), primary_key=True, autoincrement=False)
+    group_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    member_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    open_group_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    event_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    request_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    accepted_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    denied_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+class CourseWeeklyEvents(db.Model):
+    """
+    Number of events per course per week (weeks start on Monday).
+    """
+    __tablename__ = "course_weekly_events"
+    course_id = db.Column(db.Integer, db.ForeignKey("course.id", ondelete="CASCADE"), primary_key=True, autoincrement=False)
+    week_start = db.Column(db.Date, primary_key=True)
+    event_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+class Change(db.Model):
+    """
+    Change log entry. The id doubles as the sync cursor handed to clients.
+    """
+    __tablename__ = "change"
+    __table_args__ = (
+        db.Index("ix_change_group_id_id", "group_id", "id"),
+        db.Index("ix_change_user_id_id", "user_id", "id"),
+        {"sqlite_autoincrement": True}
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    entity = db.Column(db.String, nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String, nullable=False)
+    group_id = db.Column(db.Integer, nullable=True)
+    user_id = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    def serialize(self):
+        """
+        Serialize a Change object.
+        """
+        return {
+            "cursor": self.id,
+            "entity": self.entity,
+            "id": self.entity_id,
+            "op": self.op,
+            "group_id": self.group_id,
+            "user_id": self.user_id
+        }
+
+class ChangeCompaction(db.Model):
+    """
+    Record of a change log compaction. Cursors below the horizon can no longer
+    be served incrementally.
+    """
+    __tablename__ = "change_compaction"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    horizon = db.Column(db.Integer, nullable=False)
+    compacted_at = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,170 @@
+"""
+Deletion
+
+Deletes events, groups and courses with a handful of set-based statements
+instead of loading every child row into the session. The foreign keys in
+db.py are declared ON DELETE CASCADE, so deleting the parent row is enough
+for the database to remove events, requests, attendance, waitlist and
+membership rows. Databases created before the cascades were declared keep
+their old foreign keys (SQLite cannot alter them in place), so for those the
+children are deleted explicitly, bottom-up.
+
+Archived events and requests have no foreign key to their group and are
+always deleted explicitly. Change log rows are written with INSERT ... SELECT
+before the rows they describe disappear.
+"""
+
+import datetime
+from threading import Lock
+
+from sqlalchemy import inspect, literal, null, select
+
+import analytics
+import changelog
+import read_model
+from db import db
+from db import ArchivedEvent
+from db import ArchivedRequest
+from db import Change
+from db import Course
+from db import CourseStats
+from db import CourseWeeklyEvents
+from db import Event
+from db import Group
+from db import Request
+from db import archived_user_event_association_table
+from db import event_waitlist_table
+from db import user_event_association_table
+from db import user_group_association_table
+
+
+#Whether each engine's foreign keys cascade, by engine
+_cascades = {}
+_cascades_lock = Lock()
+
+
+def supports_cascade(engine):
+    """
+    Returns true if every foreign key declared ON DELETE CASCADE in db.py
+    also cascades in the database behind an engine
+    """
+    engine = getattr(engine, "engine", engine)
+    with _cascades_lock:
+        if engine not in _cascades:
+            _cascades[engine] = _inspect_cascades(engine)
+        return _cascades[engine]
+
+
+def _inspect_cascades(engine):
+    inspector = inspect(engine)
+    for table in db.metadata.sorted_tables:
+        declared = {(fk.parent.name, fk.column.table.name)
+                    for fk in table.foreign_keys if (fk.ondelete or "").upper() == "CASCADE"}
+        if not declared:
+            continue
+        actual = {(fk["constrained_columns"][0], fk["referred_table"])
+                  for fk in inspector.get_foreign_keys(table.name)
+                  if (fk.get("options") or {}).get("ondelete", "").upper() == "CASCADE"}
+        if not declared <= actual:
+            return False
+    return True
+
+
+def _cascading():
+    return supports_cascade(db.session.get_bind())
+
+
+def _record_deletes(entity, entity_id, group_id, user_id, where):
+    """
+    Appends a delete change row for every row matching a condition
+    """
+    db.session.execute(Change.__table__.insert().from_select(
+        ["entity", "entity_id", "op", "group_id", "user_id", "created_at"],
+        select(literal(entity), entity_id, literal(changelog.DELETE), group_id, user_id,
+               literal(datetime.datetime.now(), db.DateTime)).where(where)))
+
+
+def _record_group_deletes(group_ids):
+    group = Group.__table__.c
+    members = user_group_association_table.c
+    request = Request.__table__.c
+    _record_deletes("group", group.id, group.id, null(), group.id.in_(group_ids))
+    #Members lose access to the group's scope, so address them directly
+    _record_deletes("group", members.group_id, null(), members.user_id, members.group_id.in_(group_ids))
+    _record_deletes("request", request.id, request.group_id, request.user_id, request.group_id.in_(group_ids))
+    #Event rows are left out: they are scoped to the group, which no one can see any more
+    for (id,) in db.session.execute(select(Group.id).where(Group.id.in_(group_ids))):
+        read_model.mark(db.session, read_model.GROUP, id)
+
+
+def _delete_event_children(event_ids):
+    waitlist = event_waitlist_table.c
+    attending = user_event_association_table.c
+    db.session.execute(event_waitlist_table.delete().where(waitlist.event_id.in_(event_ids)))
+    db.session.execute(user_event_association_table.delete().where(attending.event_id.in_(event_ids)))
+
+
+def _delete_archived(group_ids):
+    """
+    Archived rows are not linked to their group by a foreign key
+    """
+    if not _cascading():
+        archived = select(ArchivedEvent.id).where(ArchivedEvent.group_id.in_(group_ids))
+        db.session.execute(archived_user_event_association_table.delete().where(
+            archived_user_event_association_table.c.event_id.in_(archived)))
+    db.session.execute(ArchivedEvent.__table__.delete().where(ArchivedEvent.group_id.in_(group_ids)))
+    db.session.execute(ArchivedRequest.__table__.delete().where(ArchivedRequest.group_id.in_(group_ids)))
+
+
+def _delete_group_children(group_ids):
+    """
+    What ON DELETE CASCADE does for a group, for databases without it
+    """
+    _delete_event_children(select(Event.id).where(Event.group_id.in_(group_ids)))
+    db.session.execute(Event.__table__.delete().where(Event.group_id.in_(group_ids)))
+    db.session.execute(Request.__table__.delete().where(Request.group_id.in_(group_ids)))
+    db.session.execute(user_group_association_table.delete().where(
+        user_group_association_table.c.group_id.in_(group_ids)))
+
+
+def delete_events(event_ids):
+    """
+    Deletes events with their attendance and waitlist rows. Does not commit
+    or update analytics.
+    """
+    event = Event.__table__.c
+    _record_deletes("event", event.id, event.group_id, null(), event.id.in_(event_ids))
+    if not _cascading():
+        _delete_event_children(event_ids)
+    db.session.execute(Event.__table__.delete().where(event.id.in_(event_ids)))
+
+
+def delete_groups(group_ids):
+    """
+    Deletes groups with their events, requests, memberships and archived
+    rows, and recomputes the analytics of their courses. Does not commit.
+    """
+    course_ids = [row[0] for row in db.session.execute(
+        select(Group.course_id).where(Group.id.in_(group_ids)).distinct())]
+    _record_group_deletes(group_ids)
+    _delete_archived(group_ids)
+    if not _cascading():
+        _delete_group_children(group_ids)
+    db.session.execute(Group.__table__.delete().where(Group.id.in_(group_ids)))
+    analytics.rebuild(course_ids)
+
+
+def delete_course(course_id):
+    """
+    Deletes a course with all of its groups and summary rows. Does not commit.
+    """
+    group_ids = select(Group.id).where(Group.course_id == course_id)
+    _record_group_deletes(group_ids)
+    read_model.mark(db.session, read_model.COURSE, course_id)
+    _delete_archived(group_ids)
+    if not _cascading():
+        _delete_group_children(group_ids)
+        db.session.execute(Group.__table__.delete().where(Group.course_id == course_id))
+        db.session.execute(CourseStats.__table__.delete().where(CourseStats.course_id == course_id))
+        db.session.execute(CourseWeeklyEvents.__table__.delete().where(CourseWeeklyEvents.course_id == course_id))
+    db.session.execute(Course.__table__.delete().where(Course.id == course_id))
@@ -0,0 +1,462 @@
+"""
+GraphQL
+
+Read-only GraphQL schema over User, Course, Group, Event and Request, served
+at /graphql/. Field names and scalar shapes match the JSON returned by the
+REST routes, and so do the authorization rules: courses, groups and their
+members are public, a group's events and requests are visible to its members
+only, and the events a user attends are visible to that user only.
+
+Every object and relationship is resolved through per-request DataLoaders.
+Loads made while one level of the query is being resolved are collected and
+sent as a single IN (...) query per loader, so a query costs one SQL query
+per type and relationship per level of nesting, however many rows it
+touches. Queries deeper than GRAPHQL_MAX_DEPTH or costlier than
+GRAPHQL_MAX_COST are rejected before anything runs. Introspection fields
+are charged like any other field, so tools that send the full introspection
+query need the limits raised.
+"""
+
+import asyncio
+from inspect import isawaitable
+
+from graphql import (GraphQLArgument, GraphQLBoolean, GraphQLError, GraphQLField, GraphQLInt,
+                     GraphQLList, GraphQLNonNull, GraphQLObjectType, GraphQLSchema, GraphQLString,
+                     FieldNode, FragmentSpreadNode, OperationDefinitionNode,
+                     SchemaMetaFieldDef, TypeMetaFieldDef, TypeNameMetaFieldDef,
+                     execute, get_named_type, get_nullable_type, get_operation_root_type,
+                     is_list_type, parse, specified_rules, validate)
+from sqlalchemy import select
+
+from db import db
+from db import Course
+from db import Event
+from db import Group
+from db import Request
+from db import User
+from db import user_event_association_table
+from db import user_group_association_table
+
+
+DEFAULT_MAX_DEPTH = 10
+DEFAULT_MAX_COST = 5000
+#Assumed size of a list field when estimating cost
+LIST_COST_FACTOR = 10
+
+
+#DataLoader
+
+class DataLoader:
+    """
+    Collects keys passed to load() and resolves them with one call to
+    batch_load(keys), which returns the values in key order. Each key is
+    loaded at most once per loader.
+
+    The batch goes out on the next turn of the event loop, after every
+    resolver that was waiting on the previous batch has queued its keys.
+    """
+
+    def __init__(self, batch_load):
+        self.batch_load = batch_load
+        self.cache = {}
+        self.queue = []
+
+    def load(self, key):
+        future = self.cache.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self.cache[key] = loop.create_future()
+            if not self.queue:
+                loop.call_soon(self.dispatch)
+            self.queue.append((key, future))
+        return future
+
+    def load_many(self, keys):
+        return asyncio.gather(*(self.load(key) for key in keys))
+
+    def dispatch(self):
+        queue, self.queue = self.queue, []
+        try:
+            values = self.batch_load([key for key, _ in queue])
+        except Exception as e:
+            for _, future in queue:
+                future.set_exception(e)
+            return
+        for (_, future), value in zip(queue, values):
+            future.set_result(value)
+
+
+def _by_id(model):
+    def batch_load(ids):
+        rows = {row.id: row for row in model.query.filter(model.id.in_(ids))}
+        return [rows.get(id) for id in ids]
+    return batch_load
+
+
+def _ids_by(key_column, value_column, order_by=None):
+    """
+    Batch loader returning, for each key, the list of ids related to it
+    """
+    def batch_load(keys):
+        related = {key: [] for key in keys}
+        query = select(key_column, value_column).where(key_column.in_(keys))
+        if order_by is not None:
+            query = query.order_by(order_by)
+        for key, value in db.session.execute(query):
+            related[key].append(value)
+        return [related[key] for key in keys]
+    return batch_load
+
+
+class Loaders:
+    """
+    The DataLoaders of one request
+    """
+
+    def __init__(self):
+        members = user_group_association_table.c
+        attending = user_event_association_table.c
+        self.users = DataLoader(_by_id(User))
+        self.courses = DataLoader(_by_id(Course))
+        self.groups = DataLoader(_by_id(Group))
+        self.events = DataLoader(_by_id(Event))
+        self.requests = DataLoader(_by_id(Request))
+        self.group_members = DataLoader(_ids_by(members.group_id, members.user_id))
+        self.user_groups = DataLoader(_ids_by(members.user_id, members.group_id))
+        self.event_attendees = DataLoader(_ids_by(attending.event_id, attending.user_id))
+        self.user_events = DataLoader(_ids_by(attending.user_id, attending.event_id))
+        self.course_groups = DataLoader(_ids_by(Group.course_id, Group.id, Group.id))
+        self.group_events = DataLoader(_ids_by(Event.group_id, Event.id, Event.time))
+        self.group_requests = DataLoader(_ids_by(Request.group_id, Request.id, Request.id))
+
+
+class Context:
+    """
+    Per-request state handed to every resolver as info.context
+    """
+
+    def __init__(self, viewer):
+        self.viewer = viewer
+        self.loaders = Loaders()
+        self._viewer_group_ids = None
+
+    async def viewer_group_ids(self):
+        if self.viewer is None:
+            return set()
+        if self._viewer_group_ids is None:
+            self._viewer_group_ids = set(await self.loaders.user_groups.load(self.viewer.id))
+        return self._viewer_group_ids
+
+    def require_viewer(self):
+        if self.viewer is None:
+            raise GraphQLError("Invalid session token")
+        return self.viewer
+
+    async def require_member(self, group_id):
+        self.require_viewer()
+        if group_id not in await self.viewer_group_ids():
+            raise GraphQLError("User is not a member of this group")
+
+
+#Resolvers
+
+def _loaders(info):
+    return info.context.loaders
+
+
+async def _load_all(loader, ids):
+    return [row for row in await loader.load_many(ids) if row is not None]
+
+
+async def resolve_user_groups(user, info):
+    return await _load_all(_loaders(info).groups, await _loaders(info).user_groups.load(user.id))
+
+
+async def resolve_user_events(user, info):
+    viewer = info.context.require_viewer()
+    if viewer.id != user.id:
+        raise GraphQLError("You do not have permission to view this user's events")
+    return await _load_all(_loaders(info).events, await _loaders(info).user_events.load(user.id))
+
+
+async def resolve_course_groups(course, info):
+    return await _load_all(_loaders(info).groups, await _loaders(info).course_groups.load(course.id))
+
+
+async def resolve_group_course_code(group, info):
+    course = await _loaders(info).courses.load(group.course_id)
+    return course.course_code
+
+
+async def resolve_group_users(group, info):
+    return await _load_all(_loaders(info).users, await _loaders(info).group_members.load(group.id))
+
+
+async def resolve_group_events(group, info):
+    await info.context.require_member(group.id)
+    return await _load_all(_loaders(info).events, await _loaders(info).group_events.load(group.id))
+
+
+async def resolve_group_requests(group, info):
+    await info.context.require_member(group.id)
+    return await _load_all(_loaders(info).requests, await _loaders(info).group_requests.load(group.id))
+
+
+async def resolve_event_attendees(event, info):
+    return await _load_all(_loaders(info).users, await _loaders(info).event_attendees.load(event.id))
+
+
+def resolve_me(root, info):
+    return info.context.require_viewer()
+
+
+async def resolve_user(root, info, id=None, net_id=None):
+    if id is not None:
+        return await _loaders(info).users.load(id)
+    if net_id is not None:
+        return User.query.filter_by(net_id = net_id).first()
+    raise GraphQLError("Either id or net_id is required.")
+
+
+def resolve_users(root, info):
+    return User.query.order_by(User.id).all()
+
+
+async def resolve_course(root, info, id=None, course_code=None):
+    if id is not None:
+        return await _loaders(info).courses.load(id)
+    if course_code is not None:
+        return Course.query.filter_by(course_code = course_code).first()
+    raise GraphQLError("Either id or course_code is required.")
+
+
+def resolve_courses(root, info):
+    return Course.query.order_by(Course.id).all()
+
+
+async def resolve_group(root, info, id):
+    return await _loaders(info).groups.load(id)
+
+
+def resolve_groups(root, info, course_code=None):
+    if course_code is None:
+        return Group.query.order_by(Group.id).all()
+    course = Course.query.filter_by(course_code = course_code).first()
+    if course is None:
+        raise GraphQLError("A course with this code does not exist.")
+    return Group.query.filter_by(course_id = course.id).order_by(Group.id).all()
+
+
+async def resolve_event(root, info, id):
+    event = await _loaders(info).events.load(id)
+    if event is not None:
+        await info.context.require_member(event.group_id)
+    return event
+
+
+async def resolve_request(root, info, id):
+    the_request = await _loaders(info).requests.load(id)
+    if the_request is not None:
+        await info.context.require_member(the_request.group_id)
+    return the_request
+
+
+def _loaded(loader_name, key):
+    """
+    Resolver for a to-one relationship stored as a foreign key column
+    """
+    def resolve(obj, info):
+        return getattr(_loaders(info), loader_name).load(getattr(obj, key))
+    return resolve
+
+
+#Schema
+
+def _list_of(type_):
+    return GraphQLNonNull(GraphQLList(GraphQLNonNull(type_)))
+
+
+def _private_list_of(type_):
+    #Nullable, so a field the viewer may not see resolves to null with an
+    #error instead of nulling out its parent
+    return GraphQLList(GraphQLNonNull(type_))
+
+
+UserType = GraphQLObjectType("User", lambda: {
+    "id": GraphQLField(GraphQLNonNull(GraphQLInt)),
+    "net_id": GraphQLField(GraphQLNonNull(GraphQLString)),
+    "name": GraphQLField(GraphQLNonNull(GraphQLString)),
+    "bio": GraphQLField(GraphQLString),
+    "groups": GraphQLField(_list_of(GroupType), resolve=resolve_user_groups),
+    "events_attending": GraphQLField(_private_list_of(EventType), resolve=resolve_user_events,
+                                     description="Private to the user"),
+})
+
+CourseType = GraphQLObjectType("Course", lambda: {
+    "id": GraphQLField(GraphQLNonNull(GraphQLInt)),
+    "course_code": GraphQLField(GraphQLNonNull(GraphQLString)),
+    "course_title": GraphQLField(GraphQLNonNull(GraphQLString)),
+    "groups": GraphQLField(_list_of(GroupType), resolve=resolve_course_groups),
+})
+
+GroupType = GraphQLObjectType("Group", lambda: {
+    "id": GraphQLField(GraphQLNonNull(GraphQLInt)),
+    "course_id": GraphQLField(GraphQLNonNull(GraphQLInt)),
+    "course_code": GraphQLField(GraphQLNonNull(GraphQLString), resolve=resolve_group_course_code),
+    "course": GraphQLField(GraphQLNonNull(CourseType), resolve=_loaded("courses", "course_id")),
+    "admin_id": GraphQLField(GraphQLNonNull(GraphQLInt)),
+    "admin": GraphQLField(GraphQLNonNull(UserType), resolve=_loaded("users", "admin_id")),
+    "accepting_members": GraphQLField(GraphQLNonNull(GraphQLBoolean)),
+    "users": GraphQLField(_list_of(UserType), resolve=resolve_group_users),
+    "events": GraphQLField(_private_list_of(EventType), resolve=resolve_group_events,
+                           description="Visible to members of the group"),
+    "requests": GraphQLField(_private_list_of(RequestType), resolve=resolve_group_requests,
+                             description="Visible to members of the group"),
+})
+
+EventType = GraphQLObjectType("Event", lambda: {
+    "id": GraphQLField(GraphQLNonNull(GraphQLInt)),
+    "description": GraphQLField(GraphQLNonNull(GraphQLString)),
+    "location": GraphQLField(GraphQLNonNull(GraphQLString)),
+    "time": GraphQLField(GraphQLNonNull(GraphQLString), resolve=lambda event, info: str(event.time)),
+    "capacity": GraphQLField(GraphQLInt),
+    "group_id": GraphQLField(GraphQLNonNull(GraphQLInt)),
+    "group": GraphQLField(GraphQLNonNull(GroupType), resolve=_loaded("groups", "group_id")),
+    "attendees": GraphQLField(_list_of(UserType), resolve=resolve_event_attendees),
+})
+
+RequestType = GraphQLObjectType("Request", lambda: {
+    "id": GraphQLField(GraphQLNonNull(GraphQLInt)),
+    "status": GraphQLField(GraphQLBoolean),
+    "user_id": GraphQLField(GraphQLNonNull(GraphQLInt)),
+    "user": GraphQLField(GraphQLNonNull(UserType), resolve=_loaded("users", "user_id")),
+    "group_id": GraphQLField(GraphQLNonNull(GraphQLInt)),
+    "group": GraphQLField(GraphQLNonNull(GroupType), resolve=_loaded("groups", "group_id")),
+})
+
+QueryType = GraphQLObjectType("Query", {
+    "me": GraphQLField(UserType, resolve=resolve_me),
+    "user": GraphQLField(UserType, resolve=resolve_user, args={
+        "id": GraphQLArgument(GraphQLInt),
+        "net_id": GraphQLArgument(GraphQLString)}),
+    "users": GraphQLField(_list_of(UserType), resolve=resolve_users),
+    "course": GraphQLField(CourseType, resolve=resolve_course, args={
+        "id": GraphQLArgument(GraphQLInt),
+        "course_code": GraphQLArgument(GraphQLString)}),
+    "courses": GraphQLField(_list_of(CourseType), resolve=resolve_courses),
+    "group": GraphQLField(GroupType, resolve=resolve_group, args={
+        "id": GraphQLArgument(GraphQLNonNull(GraphQLInt))}),
+    "groups": GraphQLField(_list_of(GroupType), resolve=resolve_groups, args={
+        "course_code": GraphQLArgument(GraphQLString)}),
+    "event": GraphQLField(EventType, resolve=resolve_event, args={
+        "id": GraphQLArgument(GraphQLNonNull(GraphQLInt))}),
+    "request": GraphQLField(RequestType, resolve=resolve_request, args={
+        "id": GraphQLArgument(GraphQLNonNull(GraphQLInt))}),
+})
+
+SCHEMA = GraphQLSchema(query=QueryType)
+
+
+#Cost limits
+
+def _field(parent_type, name):
+    if name == "__typename":
+        return TypeNameMetaFieldDef
+    if parent_type is SCHEMA.query_type and name == "__schema":
+        return SchemaMetaFieldDef
+    if parent_type is SCHEMA.query_type and name == "__type":
+        return TypeMetaFieldDef
+    return parent_type.fields[name]
+
+
+def _selection_cost(parent_type, selection_set, fragments, depth):
+    """
+    Returns (cost, depth) of a selection set. Every field costs 1, and the
+    selections under a list field count LIST_COST_FACTOR times. Introspection
+    fields are charged the same way, since aliases let a query repeat them.
+    """
+    cost, max_depth = 0, depth
+    for selection in selection_set.selections:
+        if isinstance(selection, FieldNode):
+            field = _field(parent_type, selection.name.value)
+            field_cost, field_depth = 1, depth + 1
+            if selection.selection_set is not None:
+                child_cost, field_depth = _selection_cost(
+                    get_named_type(field.type), selection.selection_set, fragments, depth + 1)
+                if is_list_type(get_nullable_type(field.type)):
+                    child_cost *= LIST_COST_FACTOR
+                field_cost += child_cost
+        else:
+            if isinstance(selection, FragmentSpreadNode):
+                fragment = fragments[selection.name.value]
+            else:
+                fragment = selection
+            fragment_type = parent_type
+            if fragment.type_condition is not None:
+                fragment_type = SCHEMA.get_type(fragment.type_condition.name.value)
+            field_cost, field_depth = _selection_cost(fragment_type, fragment.selection_set, fragments, depth)
+        cost += field_cost
+        max_depth = max(max_depth, field_depth)
+    return cost, max_depth
+
+
+def query_cost(document, operation_name=None):
+    """
+    Returns (cost, depth) of the operation a validated document will run
+    """
+    fragments = {}
+    operations = []
+    for definition in document.definitions:
+        if isinstance(definition, OperationDefinitionNode):
+            operations.append(definition)
+        else:
+            fragments[definition.name.value] = definition
+    operation = operations[0] if operation_name is None else next(
+        (o for o in operations if o.name is not None and o.name.value == operation_name), None)
+    if operation is None:
+        return 0, 0
+    root = get_operation_root_type(SCHEMA, operation)
+    return _selection_cost(root, operation.selection_set, fragments, 0)
+
+
+#Execution
+
+def run_query(source, variables=None, operation_name=None, viewer=None,
+              max_depth=DEFAULT_MAX_DEPTH, max_cost=DEFAULT_MAX_COST):
+    """
+    Parses, validates, cost-checks and executes a query
+
+    Returns (response body, status code)
+    """
+    if not isinstance(source, str) or not source.strip():
+        return {"errors": [{"message": "Missing query."}]}, 400
+    if variables is not None and not isinstance(variables, dict):
+        return {"errors": [{"message": "Variables must be an object."}]}, 400
+    try:
+        document = parse(source)
+    except GraphQLError as e:
+        return {"errors": [e.formatted]}, 400
+    errors = validate(SCHEMA, document, specified_rules)
+    if errors:
+        return {"errors": [e.formatted for e in errors]}, 400
+
+    try:
+        cost, depth = query_cost(document, operation_name)
+    except GraphQLError as e:
+        #The schema has no mutation or subscription root
+        return {"errors": [e.formatted]}, 400
+    if depth > max_depth:
+        return {"errors": [{"message": "Query depth %d exceeds the limit of %d." % (depth, max_depth)}]}, 400
+    if cost > max_cost:
+        return {"errors": [{"message": "Query cost %d exceeds the limit of %d." % (cost, max_cost)}]}, 400
+
+    async def run():
+        result = execute(SCHEMA, document, variable_values=variables,
+                         operation_name=operation_name, context_value=Context(viewer))
+        return await result if isawaitable(result) else result
+
+    result = asyncio.run(run())
+    body = {"data": result.data}
+    if result.errors:
+        body["errors"] = [e.formatted for e in result.errors]
+    return body, 200
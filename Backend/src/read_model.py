@@ -0,0 +1,320 @@
+"""
+In-memory read model
+
+A compact snapshot of courses, groups, memberships and the users in them, used
+to serve the public catalog reads (GET /courses/, /courses/<id>/, /groups/,
+/groups/<id>/) without touching the ORM. Enabled with READ_MODEL = True.
+
+The snapshot is built on first use, one per database engine (so one per
+tenant). Commits made through db.session mark the rows they touched, and those
+rows are reloaded before the next read. Courses, groups and each course's
+group ids are kept in id order, the order the ORM routes return. Writes made by other processes are
+only picked up by a full rebuild, every READ_MODEL_MAX_AGE seconds if set.
+"""
+
+import time
+from array import array
+from bisect import insort
+from threading import RLock
+
+from flask import current_app, g
+from sqlalchemy import event, select
+from sqlalchemy.orm import attributes
+
+from db import db
+from db import Course
+from db import Group
+from db import User
+from db import user_group_association_table
+
+
+COURSE = "course"
+GROUP = "group"
+USER = "user"
+
+#Snapshots by engine
+_snapshots = {}
+_snapshots_lock = RLock()
+
+
+class UserRow:
+    __slots__ = ("id", "net_id", "name", "bio")
+
+    def __init__(self, id, net_id, name, bio):
+        self.id = id
+        self.net_id = net_id
+        self.name = name
+        self.bio = bio
+
+    def serialize_simple(self):
+        return {
+            "id": self.id,
+            "net_id": self.net_id,
+            "name": self.name,
+            "bio": self.bio
+        }
+
+
+class CourseRow:
+    __slots__ = ("id", "course_code", "course_title", "group_ids")
+
+    def __init__(self, id, course_code, course_title):
+        self.id = id
+        self.course_code = course_code
+        self.course_title = course_title
+        self.group_ids = array("l")
+
+
+class GroupRow:
+    __slots__ = ("id", "course_id", "admin_id", "accepting_members", "member_ids")
+
+    def __init__(self, id, course_id, admin_id, accepting_members):
+        self.id = id
+        self.course_id = course_id
+        self.admin_id = admin_id
+        self.accepting_members = accepting_members
+        self.member_ids = array("l")
+
+
+class Snapshot:
+    """
+    Courses, groups and members of one database, with the same serialized
+    shapes as the models in db.py
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.courses = {}
+        self.course_ids_by_code = {}
+        self.groups = {}
+        self.users = {}
+        self.pending = set()
+        self.built_at = None
+        self.lock = RLock()
+
+    #Loading
+
+    def rebuild(self):
+        """
+        Loads everything with four queries
+        """
+        members = user_group_association_table.c
+        with self.engine.connect() as conn:
+            users = conn.execute(select(User.id, User.net_id, User.name, User.bio)).all()
+            courses = conn.execute(select(Course.id, Course.course_code, Course.course_title)
+                                   .order_by(Course.id)).all()
+            groups = conn.execute(select(Group.id, Group.course_id, Group.admin_id, Group.accepting_members)
+                                  .order_by(Group.id)).all()
+            memberships = conn.execute(select(members.group_id, members.user_id)).all()
+
+        with self.lock:
+            self.pending.clear()
+            self.users = {row[0]: UserRow(*row) for row in users}
+            self.courses = {row[0]: CourseRow(*row) for row in courses}
+            self.course_ids_by_code = {c.course_code: c.id for c in self.courses.values()}
+            self.groups = {}
+            for row in groups:
+                group = self.groups[row[0]] = GroupRow(*row)
+                course = self.courses.get(group.course_id)
+                if course is not None:
+                    course.group_ids.append(group.id)
+            for group_id, user_id in memberships:
+                group = self.groups.get(group_id)
+                if group is not None:
+                    group.member_ids.append(user_id)
+            self.built_at = time.monotonic()
+
+    def refresh(self):
+        """
+        Reloads rows touched by commits since the last read
+        """
+        with self.lock:
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, set()
+            ids = {COURSE: set(), GROUP: set(), USER: set()}
+            for kind, id in pending:
+                ids[kind].add(id)
+            with self.engine.connect() as conn:
+                if ids[USER]:
+                    self._refresh_users(conn, ids[USER])
+                if ids[COURSE]:
+                    self._refresh_courses(conn, ids[COURSE])
+                if ids[GROUP]:
+                    self._refresh_groups(conn, ids[GROUP])
+
+    def _refresh_users(self, conn, ids):
+        for id in ids:
+            self.users.pop(id, None)
+        for row in conn.execute(select(User.id, User.net_id, User.name, User.bio).where(User.id.in_(ids))):
+            self.users[row[0]] = UserRow(*row)
+
+    def _refresh_courses(self, conn, ids):
+        old = {id: self.courses.pop(id) for id in ids if id in self.courses}
+        for course in old.values():
+            self.course_ids_by_code.pop(course.course_code, None)
+        rows = conn.execute(select(Course.id, Course.course_code, Course.course_title).where(Course.id.in_(ids)))
+        for row in rows:
+            course = self.courses[row[0]] = CourseRow(*row)
+            if row[0] in old:
+                course.group_ids = old[row[0]].group_ids
+            self.course_ids_by_code[course.course_code] = course.id
+        self.courses = dict(sorted(self.courses.items()))
+
+    def _refresh_groups(self, conn, ids):
+        for id in ids:
+            group = self.groups.pop(id, None)
+            if group is not None and group.course_id in self.courses:
+                course = self.courses[group.course_id]
+                course.group_ids = array("l", (g for g in course.group_ids if g != id))
+        members = user_group_association_table.c
+        rows = conn.execute(select(Group.id, Group.course_id, Group.admin_id, Group.accepting_members)
+                            .where(Group.id.in_(ids)).order_by(Group.id))
+        for row in rows:
+            group = self.groups[row[0]] = GroupRow(*row)
+            course = self.courses.get(group.course_id)
+            if course is not None:
+                insort(course.group_ids, group.id)
+        self.groups = dict(sorted(self.groups.items()))
+        for group_id, user_id in conn.execute(select(members.group_id, members.user_id)
+                                              .where(members.group_id.in_(ids))):
+            group = self.groups.get(group_id)
+            if group is not None:
+                group.member_ids.append(user_id)
+
+    #Serialization
+
+    def _course_code(self, course_id):
+        course = self.courses.get(course_id)
+        return None if course is None else course.course_code
+
+    def serialize_group_simple(self, group):
+        return {
+            "id": group.id,
+            "course_id": group.course_id,
+            "course_code": self._course_code(group.course_id),
+            "admin_id": group.admin_id,
+            "accepting_members": group.accepting_members
+        }
+
+    def serialize_group(self, group):
+        users = self.users
+        return {
+            "id": group.id,
+            "course_id": group.course_id,
+            "course_code": self._course_code(group.course_id),
+            "admin_id": group.admin_id,
+            "users": [users[u].serialize_simple() for u in group.member_ids if u in users],
+            "accepting_members": group.accepting_members
+        }
+
+    def serialize_course(self, course):
+        return {
+            "id": course.id,
+            "course_code": course.course_code,
+            "course_title": course.course_title,
+            "groups": [self.serialize_group_simple(self.groups[g]) for g in course.group_ids]
+        }
+
+    def get_course(self, course_id):
+        with self.lock:
+            course = self.courses.get(course_id)
+            return None if course is None else self.serialize_course(course)
+
+    def get_courses(self):
+        with self.lock:
+            return [self.serialize_course(c) for c in self.courses.values()]
+
+    def get_group(self, group_id):
+        with self.lock:
+            group = self.groups.get(group_id)
+            return None if group is None else self.serialize_group(group)
+
+    def get_groups(self, course_code=None):
+        """
+        Returns all groups, or those of one course. None if the course does not exist.
+        """
+        with self.lock:
+            if course_code is None:
+                return [self.serialize_group(g) for g in self.groups.values()]
+            course_id = self.course_ids_by_code.get(course_code)
+            if course_id is None:
+                return None
+            return [self.serialize_group(self.groups[g]) for g in self.courses[course_id].group_ids]
+
+
+def current():
+    """
+    Returns the up to date snapshot for the current request's database, or
+    None if the read model is disabled
+    """
+    if not current_app.config.get("READ_MODEL"):
+        return None
+    engine = g.get("tenant_engine") or db.engine
+    with _snapshots_lock:
+        snapshot = _snapshots.get(engine)
+        if snapshot is None:
+            snapshot = _snapshots[engine] = Snapshot(engine)
+    max_age = current_app.config.get("READ_MODEL_MAX_AGE")
+    with snapshot.lock:
+        if snapshot.built_at is None or (max_age is not None and time.monotonic() - snapshot.built_at > max_age):
+            snapshot.rebuild()
+        else:
+            snapshot.refresh()
+    return snapshot
+
+
+def reset():
+    """
+    Drops every snapshot
+    """
+    with _snapshots_lock:
+        _snapshots.clear()
+
+
+#Change tracking
+
+def mark(session, kind, id):
+    """
+    Marks a row as changed; it is reloaded after the session commits. Used
+    directly by writes that bypass the ORM.
+    """
+    session.info.setdefault("read_model_dirty", set()).add((kind, id))
+
+
+def _user_changed(user):
+    return any(attributes.get_history(user, key).has_changes() for key in ("net_id", "name", "bio"))
+
+
+@event.listens_for(db.session, "after_flush")
+def _after_flush(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Course):
+            mark(session, COURSE, obj.id)
+        elif isinstance(obj, Group):
+            mark(session, GROUP, obj.id)
+            for user in attributes.get_history(obj, "users").added:
+                mark(session, USER, user.id)
+        elif isinstance(obj, User) and (obj in session.deleted or _user_changed(obj)):
+            mark(session, USER, obj.id)
+
+
+@event.listens_for(db.session, "after_commit")
+def _after_commit(session):
+    dirty = session.info.pop("read_model_dirty", None)
+    if not dirty:
+        return
+    snapshot = _snapshots.get(_bind(session))
+    if snapshot is not None:
+        with snapshot.lock:
+            snapshot.pending.update(dirty)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _after_rollback(session):
+    session.info.pop("read_model_dirty", None)
+
+
+def _bind(session):
+    engine = session.get_bind()
+    return getattr(engine, "engine", engine)
@@ -0,0 +1,118 @@
+"""
+RSVP
+
+Joining and leaving events without read-modify-write races. The event row is
+locked first (SELECT ... FOR UPDATE; SQLite serializes writers anyway), then a
+single conditional INSERT ... SELECT adds the attendee only if they are not
+already attending and the event is below capacity. The unique index on
+user_event_assoc(user_id, event_id) backs up the duplicate check. Users who
+find the event full join a first-come first-served waitlist, and a seat freed
+by leave() goes to the head of the waitlist in the same transaction.
+"""
+
+from sqlalchemy import and_, exists, func, insert, literal, or_, select
+
+import changelog
+from db import db
+from db import Event
+from db import event_waitlist_table
+from db import user_event_association_table
+
+
+ATTENDING = "attending"
+WAITLISTED = "waitlisted"
+
+
+def _lock_event(event_id):
+    db.session.execute(select(Event.id).where(Event.id == event_id).with_for_update())
+
+
+def _is_attending(event_id, user_id):
+    attending = user_event_association_table.c
+    return exists().where(attending.event_id == event_id, attending.user_id == user_id)
+
+
+def _try_attend(event_id, user_id):
+    """
+    Adds an attendee if there is room and they are not attending yet.
+
+    Returns true if a row was inserted
+    """
+    attending = user_event_association_table.c
+    capacity = select(Event.capacity).where(Event.id == event_id).scalar_subquery()
+    taken = select(func.count()).select_from(user_event_association_table).where(
+        attending.event_id == event_id).scalar_subquery()
+    result = db.session.execute(insert(user_event_association_table).from_select(
+        ["user_id", "event_id"],
+        select(literal(user_id), literal(event_id)).where(and_(
+            ~_is_attending(event_id, user_id),
+            or_(capacity.is_(None), taken < capacity)))))
+    return result.rowcount == 1
+
+
+def _add_to_waitlist(event_id, user_id):
+    waitlist = event_waitlist_table.c
+    db.session.execute(insert(event_waitlist_table).from_select(
+        ["event_id", "user_id"],
+        select(literal(event_id), literal(user_id)).where(
+            ~exists().where(waitlist.event_id == event_id, waitlist.user_id == user_id))))
+
+
+def waitlist_position(event_id, user_id):
+    """
+    Returns the user's 1-based position on the event's waitlist, or None
+    """
+    waitlist = event_waitlist_table.c
+    entry = select(waitlist.id).where(waitlist.event_id == event_id, waitlist.user_id == user_id).scalar_subquery()
+    position = db.session.execute(select(func.count()).where(
+        waitlist.event_id == event_id, waitlist.id <= entry)).scalar()
+    return position or None
+
+
+def join(event, user_id):
+    """
+    Adds a user to an event, or to its waitlist if it is full. Does not commit.
+
+    Returns ATTENDING or WAITLISTED
+    """
+    _lock_event(event.id)
+    if _try_attend(event.id, user_id):
+        changelog.record(db.session, changelog.attendance_rows(event.id, event.group_id, [user_id], changelog.INSERT))
+        return ATTENDING
+    if db.session.execute(select(_is_attending(event.id, user_id))).scalar():
+        return ATTENDING
+    _add_to_waitlist(event.id, user_id)
+    return WAITLISTED
+
+
+def leave(event, user_id):
+    """
+    Removes a user from an event or its waitlist and gives freed seats to the
+    waitlist. Does not commit.
+
+    Returns the ids of promoted users, or None if the user was neither
+    attending nor waitlisted
+    """
+    attending = user_event_association_table.c
+    waitlist = event_waitlist_table.c
+    _lock_event(event.id)
+
+    left_waitlist = db.session.execute(event_waitlist_table.delete().where(
+        waitlist.event_id == event.id, waitlist.user_id == user_id)).rowcount
+    left = db.session.execute(user_event_association_table.delete().where(
+        attending.event_id == event.id, attending.user_id == user_id)).rowcount
+    if not left:
+        return [] if left_waitlist else None
+
+    promoted = []
+    while True:
+        head = db.session.execute(select(waitlist.id, waitlist.user_id).where(
+            waitlist.event_id == event.id).order_by(waitlist.id).limit(1)).first()
+        if head is None or not _try_attend(event.id, head.user_id):
+            break
+        db.session.execute(event_waitlist_table.delete().where(waitlist.id == head.id))
+        promoted.append(head.user_id)
+
+    changelog.record(db.session, changelog.attendance_rows(event.id, event.group_id, [user_id], changelog.DELETE)
+                     + changelog.attendance_rows(event.id, event.group_id, promoted, changelog.INSERT))
+    return promoted
@@ -0,0 +1,225 @@
+"""
+Schema management
+
+Creates missing tables, columns and indexes so an existing database file
+catches up with the models in db.py. Only additive changes are handled;
+anything else (renames, type changes, dropped columns) needs a manual step.
+
+A unique index marked with info={"dedupe": True} has duplicate rows removed
+(keeping the oldest) before it is created on an existing table.
+
+SQLite tables declared with sqlite_autoincrement but created before it was
+(event, request) hand out the ids of deleted rows again, which breaks
+archiving: an archived id comes back for a new row. Those tables are rebuilt
+with AUTOINCREMENT, their sequence starting above the ids in their
+info["archive_table"]; live rows that already reuse an archived id get a
+new one.
+
+Deploys should run `flask init-db` (or `flask migrate-tenants`) before
+starting the app. SCHEMA_AUTO_SYNC syncs from the first request instead,
+which is convenient in development. When several processes sync at once,
+each CREATE / ALTER runs in its own transaction and a process that loses the
+race to apply one skips it.
+"""
+
+from threading import Lock
+
+from flask import g
+from sqlalchemy import exc, inspect, text
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from db import db
+
+
+def _lost_race(error):
+    """
+    True if a DDL statement failed because another process applied it first
+    """
+    message = str(error.orig).lower()
+    return "already exists" in message or "duplicate column" in message
+
+
+def _apply(engine, apply):
+    """
+    Runs apply(conn) in its own transaction
+
+    Returns false if another process made the same change first
+    """
+    try:
+        with engine.begin() as conn:
+            apply(conn)
+        return True
+    except (exc.OperationalError, exc.ProgrammingError) as e:
+        if not _lost_race(e):
+            raise
+        return False
+
+
+def sync_schema(engine):
+    """
+    Brings the database behind an engine up to date with the models. Safe to
+    run from several processes at once.
+
+    Returns a list of the statements that were applied
+    """
+    applied = []
+    existing_tables = set(inspect(engine).get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables and _apply(engine, lambda conn: table.create(conn)):
+            applied.append("CREATE TABLE %s" % table.name)
+
+    if engine.dialect.name == "sqlite":
+        for table in db.metadata.sorted_tables:
+            if table.dialect_options["sqlite"]["autoincrement"] and _rebuild_with_autoincrement(engine, table):
+                applied.append("REBUILD TABLE %s WITH AUTOINCREMENT" % table.name)
+
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    for table in db.metadata.sorted_tables:
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable and column.server_default is None:
+                raise RuntimeError("Cannot add NOT NULL column %s.%s without a server default."
+                                   % (table.name, column.name))
+            ddl = "ALTER TABLE %s ADD COLUMN %s %s" % (
+                preparer.format_table(table),
+                preparer.format_column(column),
+                column.type.compile(dialect=engine.dialect))
+            if column.server_default is not None:
+                default = column.server_default.arg
+                ddl += " DEFAULT %s" % (default.text if hasattr(default, "text") else "'%s'" % default)
+            if not column.nullable:
+                ddl += " NOT NULL"
+            if _apply(engine, lambda conn: conn.execute(text(ddl))):
+                applied.append(ddl)
+
+        existing_indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            statements = []
+            if index.unique and index.info.get("dedupe"):
+                statements.append(_dedupe_sql(engine, table, [c.name for c in index.columns]))
+
+            def create_index(conn):
+                for statement in statements:
+                    conn.execute(text(statement))
+                index.create(conn)
+
+            if _apply(engine, create_index):
+                applied.extend(statements + ["CREATE INDEX %s" % index.name])
+    return applied
+
+
+def _has_autoincrement(cursor, table):
+    row = cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                         (table.name,)).fetchone()
+    return row is None or "AUTOINCREMENT" in row[0].upper()
+
+
+def _rebuild_with_autoincrement(engine, table):
+    """
+    Rebuilds a SQLite table created without AUTOINCREMENT, following
+    https://www.sqlite.org/lang_altertable.html#otheralter
+
+    Returns false if there was nothing to do
+    """
+    preparer = engine.dialect.identifier_preparer
+    name = preparer.format_table(table)
+    new_name = preparer.quote("_new_" + table.name)
+    raw = engine.raw_connection()
+    conn = raw.connection
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    try:
+        if _has_autoincrement(cursor, table):
+            return False
+        cursor.execute("PRAGMA foreign_keys=OFF")
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            #Another process may have rebuilt it while we waited for the lock
+            if _has_autoincrement(cursor, table):
+                cursor.execute("ROLLBACK")
+                return False
+            existing = {row[1] for row in cursor.execute("PRAGMA table_info(%s)" % name)}
+            columns = ", ".join(preparer.format_column(c) for c in table.columns if c.name in existing)
+            create = str(CreateTable(table).compile(dialect=engine.dialect)).strip()
+            cursor.execute(create.replace(name, new_name, 1))
+            cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s" % (new_name, columns, columns, name))
+            cursor.execute("DROP TABLE %s" % name)
+            cursor.execute("ALTER TABLE %s RENAME TO %s" % (new_name, name))
+            for index in table.indexes:
+                cursor.execute(str(CreateIndex(index).compile(dialect=engine.dialect)))
+            _reseed(cursor, preparer, table)
+            cursor.execute("COMMIT")
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        return True
+    finally:
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+        conn.isolation_level = isolation_level
+        raw.close()
+
+
+def _reseed(cursor, preparer, table):
+    """
+    Starts a rebuilt table's id sequence above its archive's ids and moves
+    live rows whose id is already archived to fresh ids
+    """
+    name = preparer.format_table(table)
+    seq = cursor.execute("SELECT coalesce(max(id), 0) FROM %s" % name).fetchone()[0]
+    archive = table.info.get("archive_table")
+    collisions = []
+    if archive is not None and archive in db.metadata.tables:
+        archive = preparer.quote(archive)
+        seq = max(seq, cursor.execute("SELECT coalesce(max(id), 0) FROM %s" % archive).fetchone()[0])
+        collisions = [row[0] for row in cursor.execute(
+            "SELECT id FROM %s WHERE id IN (SELECT id FROM %s) ORDER BY id" % (name, archive))]
+    children = [(child, fk.parent.name) for child in db.metadata.sorted_tables
+                for fk in child.foreign_keys if fk.column.table is table]
+    for old_id in collisions:
+        seq += 1
+        cursor.execute("UPDATE %s SET id = ? WHERE id = ?" % name, (seq, old_id))
+        for child, column in children:
+            cursor.execute("UPDATE %s SET %s = ? WHERE %s = ?" % (
+                preparer.format_table(child), preparer.quote(column), preparer.quote(column)), (seq, old_id))
+    cursor.execute("DELETE FROM sqlite_sequence WHERE name = ?", (table.name,))
+    cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table.name, seq))
+
+
+def _dedupe_sql(engine, table, columns):
+    """
+    DELETE keeping the first physical row of each group of duplicates
+    """
+    row_id = "ctid" if engine.dialect.name == "postgresql" else "rowid"
+    preparer = engine.dialect.identifier_preparer
+    name = preparer.format_table(table)
+    cols = ", ".join(preparer.quote(c) for c in columns)
+    return "DELETE FROM %s WHERE %s NOT IN (SELECT min(%s) FROM %s GROUP BY %s)" % (
+        name, row_id, row_id, name, cols)
+
+
+def init_app(app):
+    """
+    Syncs the schema of each engine the first time a request uses it, when
+    SCHEMA_AUTO_SYNC is set
+    """
+    synced = set()
+    lock = Lock()
+
+    @app.before_request
+    def auto_sync_schema():
+        if not app.config["SCHEMA_AUTO_SYNC"]:
+            return
+        engine = g.get("tenant_engine") or db.engine
+        if engine in synced:
+            return
+        with lock:
+            if engine not in synced:
+                sync_schema(engine)
+                synced.add(engine)
@@ -0,0 +1,180 @@
+"""
+Multi-tenancy
+
+Each campus (tenant) gets its own database. The tenant is resolved per request
+from the X-Tenant header or from the first label of the host name, and its
+engine is stored on flask.g where db.TenantSession picks it up, so the models
+in db.py and the user_auth DAO run unchanged against whichever database the
+request resolved to. Requests that resolve no tenant use the default database.
+
+Tenant databases are either listed explicitly in TENANT_DATABASES (name -> URI,
+e.g. for PostgreSQL) or are SQLite files named <tenant>.db in TENANT_DIR,
+created with `flask create-tenant`.
+"""
+
+import os
+import re
+from contextlib import contextmanager
+from threading import Lock
+
+import sqlalchemy as sa
+from flask import current_app, g, request
+
+import schema
+
+
+#Name the default database goes by (e.g. in backup file names); no tenant can use it
+DEFAULT_NAME = "default"
+TENANT_NAME = re.compile(r"^(?!%s$)[a-z0-9][a-z0-9_-]{0,62}$" % DEFAULT_NAME)
+
+
+class TenantRegistry:
+    """
+    Lazily created engines, one per tenant
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._engines = {}
+        self._lock = Lock()
+
+    def uri(self, name):
+        """
+        Returns the database URI for a tenant, or None if it does not exist
+        """
+        if not TENANT_NAME.match(name):
+            return None
+        explicit = self.app.config["TENANT_DATABASES"].get(name)
+        if explicit is not None:
+            return explicit
+        path = self.path(name)
+        if os.path.exists(path):
+            return "sqlite:///%s" % path
+        return None
+
+    def path(self, name):
+        return os.path.abspath(os.path.join(self.app.config["TENANT_DIR"], "%s.db" % name))
+
+    def names(self):
+        """
+        Returns every known tenant
+        """
+        names = {name for name in self.app.config["TENANT_DATABASES"] if TENANT_NAME.match(name)}
+        tenant_dir = self.app.config["TENANT_DIR"]
+        if os.path.isdir(tenant_dir):
+            names.update(f[:-3] for f in os.listdir(tenant_dir)
+                         if f.endswith(".db") and TENANT_NAME.match(f[:-3]))
+        return sorted(names)
+
+    def engine(self, name):
+        """
+        Returns the engine for a tenant, creating it on first use, or None if
+        the tenant does not exist
+        """
+        engine = self._engines.get(name)
+        if engine is not None:
+            return engine
+        uri = self.uri(name)
+        if uri is None:
+            return None
+        with self._lock:
+            engine = self._engines.get(name)
+            if engine is None:
+                engine = sa.create_engine(uri, echo=self.app.config.get("SQLALCHEMY_ECHO", False),
+                                          **self.app.config["TENANT_ENGINE_OPTIONS"])
+                self._engines[name] = engine
+        return engine
+
+    def provision(self, name):
+        """
+        Creates a tenant's database (SQLite tenants only) and its schema
+        """
+        if not TENANT_NAME.match(name):
+            raise ValueError("Invalid tenant name: %s" % name)
+        if name not in self.app.config["TENANT_DATABASES"]:
+            os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+            open(self.path(name), "a").close()
+        return schema.sync_schema(self.engine(name))
+
+    def migrate(self):
+        """
+        Brings every tenant's schema up to date
+
+        Returns a dict of tenant -> applied statements
+        """
+        return {name: schema.sync_schema(self.engine(name)) for name in self.names()}
+
+    def dispose(self):
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines.clear()
+
+
+def resolve_tenant():
+    """
+    Returns the tenant named by the current request, or None
+    """
+    name = request.headers.get(current_app.config["TENANT_HEADER"])
+    if name:
+        return name.strip().lower()
+    base_domain = current_app.config["TENANT_BASE_DOMAIN"]
+    host = request.host.split(":")[0].lower()
+    if base_domain and host.endswith("." + base_domain):
+        return host[:-len(base_domain) - 1].split(".")[-1]
+    return None
+
+
+def registry():
+    return current_app.extensions["tenancy"]
+
+
+def current_engine(db):
+    """
+    Returns the engine the current request or command is bound to
+    """
+    return g.get("tenant_engine") or db.engine
+
+
+@contextmanager
+def use_tenant(name):
+    """
+    Binds db.session to a tenant for the body of a with block (CLI commands,
+    scripts). Expects an app context.
+    """
+    engine = registry().engine(name) if name else None
+    if name and engine is None:
+        raise ValueError("Unknown tenant: %s" % name)
+    previous = g.get("tenant"), g.get("tenant_engine")
+    g.tenant, g.tenant_engine = name, engine
+    try:
+        yield engine
+    finally:
+        g.tenant, g.tenant_engine = previous
+
+
+def init_app(app, fail_response):
+    """
+    Registers tenant resolution on a Flask app
+    """
+    app.config.setdefault("TENANT_HEADER", "X-Tenant")
+    app.config.setdefault("TENANT_BASE_DOMAIN", None)
+    app.config.setdefault("TENANT_DIR", "tenants")
+    app.config.setdefault("TENANT_DATABASES", {})
+    app.config.setdefault("TENANT_ENGINE_OPTIONS", {})
+    app.config.setdefault("TENANT_REQUIRED", False)
+    app.extensions["tenancy"] = TenantRegistry(app)
+
+    @app.before_request
+    def bind_tenant():
+        name = resolve_tenant()
+        if name is None:
+            if app.config["TENANT_REQUIRED"]:
+                return fail_response("No tenant given.", 400)
+            return None
+        engine = registry().engine(name)
+        if engine is None:
+            return fail_response("Unknown tenant.", 404)
+        g.tenant = name
+        g.tenant_engine = engine
+        return None
@@ -6,6 +6,7 @@ Helper file containing functions for accessing data in our database
 
 from db import User
 from db import db
+from db import user_group_association_table
 
 
 def get_user_by_net_id(net_id):
@@ -29,6 +30,15 @@ def get_user_by_update_token(update_token):
     return User.query.filter(User.update_token == update_token).first()
 
 
+def is_group_member(user_id, group_id):
+    """
+    Returns true if the user is a member (or the admin) of the group
+    """
+    members = user_group_association_table.c
+    return db.session.query(members.user_id).filter(
+        members.group_id == group_id, members.user_id == user_id).first() is not None
+
+
 def verify_credentials(net_id, password):
     """
     Returns true if the credentials match, otherwise returns false